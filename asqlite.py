@@ -28,25 +28,144 @@ import sqlite3
 import threading
 import queue
 import asyncio
+import itertools
+import functools
+import collections
+import json
+import time
+import weakref
 
 PARSE_DECLTYPES = sqlite3.PARSE_DECLTYPES
 PARSE_COLNAMES = sqlite3.PARSE_COLNAMES
 
 class _WorkerEntry:
-    __slots__ = ('func', 'args', 'kwargs', 'future', 'cancelled')
+    __slots__ = ('func', 'args', 'kwargs', 'future', 'cancelled', 'posted')
 
-    def __init__(self, func, args, kwargs, future):
+    def __init__(self, func, args, kwargs, future, posted=None):
         self.func = func
         self.args = args
         self.kwargs = kwargs
         self.future = future
+        self.posted = posted
+
+@functools.lru_cache(maxsize=512)
+def _normalize_sql(sql):
+    return ' '.join(sql.split())
+
+class _StatementStats:
+    __slots__ = ('count', 'total', 'queued', 'fetch', 'samples')
+
+    def __init__(self, samples):
+        self.count = 0
+        self.total = 0.0
+        self.queued = 0.0
+        self.fetch = 0.0
+        self.samples = collections.deque(maxlen=samples)
+
+class Stats:
+    """Opt-in timing for the statements ran by the worker threads.
+
+    Pass one to :func:`connect` or :func:`create_pool` with ``stats=``,
+    the same object can be shared by many connections.
+
+    For every normalized SQL string this keeps the call count, the total time
+    spent running on the worker, the time spent queued before the worker
+    picked it up and the latest ``samples`` run times for the percentiles.
+    Statements ran by :meth:`Connection.batch` are recorded together as one entry.
+
+    Fetching the rows of a query (``fetchone`` / ``fetchmany`` / ``fetchall`` /
+    ``async for``) is added to the total of the statement that made the cursor
+    and is also shown on its own as ``fetch_ms``. The percentiles only cover
+    the execute step.
+    """
+    def __init__(self, samples=1024):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._statements = {}
+
+    def _get(self, sql):
+        stats = self._statements.get(sql)
+        if stats is None:
+            stats = self._statements[sql] = _StatementStats(self.samples)
+        return stats
+
+    def record(self, sql, queued, elapsed):
+        """Records one run of ``sql``, times are in seconds."""
+        sql = _normalize_sql(sql)
+        with self._lock:
+            stats = self._get(sql)
+            stats.count += 1
+            stats.total += elapsed
+            stats.queued += queued
+            stats.samples.append(elapsed)
+
+    def record_fetch(self, sql, elapsed):
+        """Records time spent fetching the rows of ``sql``, in seconds."""
+        sql = _normalize_sql(sql)
+        with self._lock:
+            stats = self._get(sql)
+            stats.total += elapsed
+            stats.fetch += elapsed
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        with self._lock:
+            self._statements.clear()
+
+    def report(self):
+        """Returns a list of dicts, one per statement, with the most total time first.
+
+        Times are in milliseconds.
+        """
+        with self._lock:
+            items = [(sql, s.count, s.total, s.queued, s.fetch, sorted(s.samples))
+                     for sql, s in self._statements.items()]
+
+        report = []
+        for sql, count, total, queued, fetch, samples in items:
+            report.append({
+                'sql': sql,
+                'count': count,
+                'total_ms': total * 1000,
+                'p50_ms': samples[int(len(samples) * 0.50)] * 1000 if samples else 0.0,
+                'p99_ms': samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1000 if samples else 0.0,
+                'queued_ms': queued * 1000,
+                'fetch_ms': fetch * 1000,
+            })
+        report.sort(key=lambda r: r['total_ms'], reverse=True)
+        return report
+
+    def dump(self, path):
+        """Writes :meth:`report` to ``path`` as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+def _statement_of(entry):
+    # only statements are recorded, not fetches / commits
+    func = entry.func
+    if func is _run_batch:
+        # add_many sends the same insert once per image, its only recorded once
+        return ' ; '.join(dict.fromkeys(sql for sql, _, _ in entry.args[1]))
+    if getattr(func, '__name__', None) in ('execute', 'executemany', 'executescript') and entry.args:
+        sql = entry.args[0]
+        if isinstance(sql, str):
+            return sql
+    return None
+
+# cursor methods that pull rows, timed against the statement that made the cursor
+_FETCHES = ('fetchone', 'fetchmany', 'fetchall')
+
+# posted to the worker queue to tell the worker to stop
+_STOP = object()
 
 class _Worker(threading.Thread):
-    def __init__(self, *, loop):
+    def __init__(self, *, loop, stats=None):
         super().__init__(name='asqlite-worker-thread', daemon=True)
         self.loop = loop
-        self._worker_queue = queue.Queue()
+        self.stats = stats
+        self._worker_queue = queue.SimpleQueue()
         self._end = threading.Event()
+        self._cursors = weakref.WeakKeyDictionary()  # sqlite3.Cursor: the sql it ran, only used with stats
 
     def _call_entry(self, entry):
         fut = entry.future
@@ -54,30 +173,66 @@ class _Worker(threading.Thread):
             return
 
         try:
-            result = entry.func(*entry.args, **entry.kwargs)
+            if self.stats is not None and entry.posted is not None:
+                result = self._call_timed(entry)
+            else:
+                result = entry.func(*entry.args, **entry.kwargs)
         except Exception as e:
-            self.loop.call_soon_threadsafe(fut.set_exception, e)
+            self.loop.call_soon_threadsafe(self._set_exception, fut, e)
         else:
-            self.loop.call_soon_threadsafe(fut.set_result, result)
+            self.loop.call_soon_threadsafe(self._set_result, fut, result)
+
+    def _set_result(self, fut, result):
+        # ran on the loop, the future can be cancelled after the worker started on it
+        if fut.cancelled():
+            if isinstance(result, sqlite3.Cursor):
+                # nobody is going to close it, this has to happen on the worker thread
+                self.post(result.close)
+            return
+        fut.set_result(result)
+
+    def _set_exception(self, fut, e):
+        if not fut.cancelled():
+            fut.set_exception(e)
+
+    def _call_timed(self, entry):
+        start = time.perf_counter()
+        sql = _statement_of(entry)
+        try:
+            result = entry.func(*entry.args, **entry.kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if sql is not None:
+                self.stats.record(sql, start - entry.posted, elapsed)
+            elif getattr(entry.func, '__name__', None) in _FETCHES:
+                cursor = getattr(entry.func, '__self__', None)
+                owner = self._cursors.get(cursor) if isinstance(cursor, sqlite3.Cursor) else None
+                if owner is not None:
+                    self.stats.record_fetch(owner, elapsed)
+        if sql is not None and isinstance(result, sqlite3.Cursor):
+            self._cursors[result] = sql
+        return result
 
     def run(self):
         _queue = self._worker_queue
-        while not self._end.is_set():
-            try:
-                entry = _queue.get(timeout=0.2)
-            except queue.Empty:
-                continue
-            else:
-                self._call_entry(entry)
+        while True:
+            # blocks until there is work, no polling while idle
+            entry = _queue.get()
+            if entry is _STOP:
+                break
+            self._call_entry(entry)
 
     def post(self, func, *args, **kwargs):
         future = self.loop.create_future()
-        entry = _WorkerEntry(func=func, args=args, kwargs=kwargs, future=future)
+        posted = time.perf_counter() if self.stats is not None else None
+        entry = _WorkerEntry(func=func, args=args, kwargs=kwargs, future=future, posted=posted)
         self._worker_queue.put_nowait(entry)
         return future
 
     def stop(self):
-        self._end.set()
+        if not self._end.is_set():
+            self._end.set()
+            self._worker_queue.put(_STOP)
 
 class _ContextManagerMixin:
     def __init__(self, _queue, _factory, func, *args, timeout=None, **kwargs):
@@ -112,10 +267,49 @@ class _ContextManagerMixin:
         if self.__result is not None:
             await self.__result.close()
 
+class _CursorIterator:
+    """Pulls rows from the worker ``size`` at a time.
+
+    Only asks for the next chunk while the current one is being used,
+    so there are never more than two chunks in memory.
+    """
+    def __init__(self, cursor, size):
+        self._cursor = cursor
+        self._size = size
+        self._rows = collections.deque()
+        self._next = None
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    def _request(self):
+        if not self._done and self._next is None:
+            self._next = self._cursor._post(self._cursor._cursor.fetchmany, self._size)
+
+    async def __anext__(self):
+        if not self._rows:
+            self._request()
+            if self._next is None:
+                raise StopAsyncIteration
+            chunk = await self._next
+            self._next = None
+            if len(chunk) < self._size:
+                self._done = True
+            if not chunk:
+                raise StopAsyncIteration
+            self._rows.extend(chunk)
+            # getting the next chunk ready while this one is used
+            self._request()
+        return self._rows.popleft()
+
 class Cursor:
     """An asyncio-compatible version of :class:`sqlite3.Cursor`.
 
     Create these with :meth:`Connection.cursor`.
+
+    Rows can also be streamed with ``async for row in cursor``,
+    see :meth:`iterate`.
     """
 
     def __init__(self, connection, cursor):
@@ -129,6 +323,31 @@ class Cursor:
     async def __aexit__(self, exc_type, exc, tb):
         await self.close()
 
+    def __aiter__(self):
+        return self.iterate()
+
+    @property
+    def arraysize(self):
+        """The amount of rows pulled at once by :meth:`fetchmany` and ``async for``."""
+        return self._cursor.arraysize
+
+    @arraysize.setter
+    def arraysize(self, value):
+        self._cursor.arraysize = value
+
+    def iterate(self, size=None):
+        """Streams the rows ``size`` at a time (defaults to :attr:`arraysize`).
+
+        .. code-block:: python3
+
+            async for row in cursor.iterate(500):
+                ...
+        """
+        size = self._cursor.arraysize if size is None else size
+        if size < 1:
+            raise ValueError('size has to be at least 1')
+        return _CursorIterator(self, size)
+
     def get_cursor(self):
         """Retrieves the internal :class:`sqlite3.Cursor` object."""
         return self._cursor
@@ -169,6 +388,60 @@ class Cursor:
         """Asynchronous version of :meth:`sqlite3.Cursor.fetchall`."""
         return await self._post(self._cursor.fetchall)
 
+# what batch() gives back for each statement
+_BATCH_MODES = (None, 'one', 'all', 'lastrowid', 'rowcount', 'executemany')
+
+def _prepare_batch(statements):
+    prepared = []
+    for statement in statements:
+        if isinstance(statement, str):
+            statement = (statement,)
+        sql = statement[0]
+        parameters = statement[1] if len(statement) > 1 else ()
+        mode = statement[2] if len(statement) > 2 else None
+        if mode not in _BATCH_MODES:
+            raise ValueError(f'unknown batch mode {mode!r}')
+        if mode != 'executemany' and not callable(parameters) and not isinstance(parameters, (dict, tuple, list)):
+            # same as execute(sql, value) with a single value
+            parameters = (parameters,)
+        prepared.append((sql, parameters, mode))
+    return prepared
+
+def _run_batch(connection, statements, transaction):
+    results = []
+    if transaction:
+        connection.execute('BEGIN TRANSACTION;')
+    try:
+        for sql, parameters, mode in statements:
+            if callable(parameters):
+                parameters = parameters(results)
+            if mode == 'executemany':
+                cursor = connection.executemany(sql, parameters)
+                results.append(cursor.rowcount)
+                cursor.close()
+                continue
+
+            cursor = connection.execute(sql, parameters)
+            if mode == 'one':
+                results.append(cursor.fetchone())
+            elif mode == 'all':
+                results.append(cursor.fetchall())
+            elif mode == 'lastrowid':
+                results.append(cursor.lastrowid)
+            elif mode == 'rowcount':
+                results.append(cursor.rowcount)
+            else:
+                results.append(None)
+            cursor.close()
+    except BaseException:
+        if transaction:
+            connection.rollback()
+        raise
+    else:
+        if transaction:
+            connection.commit()
+    return results
+
 class Transaction:
     """An asyncio-compatible transaction for sqlite3.
 
@@ -288,7 +561,7 @@ class Connection:
         Note that this returns a :class:`Cursor` instead of a :class:`sqlite3.Cursor`.
         """
         factory = lambda cur: Cursor(self, cur)
-        return _ContextManagerMixin(self._queue, factory, self._conn.executescript, sql, sql_script)
+        return _ContextManagerMixin(self._queue, factory, self._conn.executescript, sql_script)
 
     async def fetchone(self, query, *parameters):
         """Shortcut method version of :meth:`sqlite3.Cursor.fetchone` without making a cursor."""
@@ -305,6 +578,159 @@ class Connection:
         async with self.execute(query, *parameters) as cursor:
             return await cursor.fetchall()
 
+    async def iterate(self, query, *parameters, size=256):
+        """Shortcut to stream the rows of a query without making a cursor.
+
+        Pulls ``size`` rows at a time, see :meth:`Cursor.iterate`.
+        """
+        async with self.execute(query, *parameters) as cursor:
+            async for row in cursor.iterate(size):
+                yield row
+
+    async def batch(self, statements, *, transaction=False):
+        """Runs a list of statements in one go on the worker thread.
+
+        Each statement is ``(sql, parameters, mode)``, where ``parameters``
+        and ``mode`` can be left out. ``mode`` decides what is given back for
+        that statement:
+
+        - ``None``: nothing (``None``)
+        - ``'one'``: :meth:`sqlite3.Cursor.fetchone`
+        - ``'all'``: :meth:`sqlite3.Cursor.fetchall`
+        - ``'lastrowid'``: :attr:`sqlite3.Cursor.lastrowid`
+        - ``'rowcount'``: :attr:`sqlite3.Cursor.rowcount`
+        - ``'executemany'``: runs :meth:`sqlite3.Cursor.executemany` with ``parameters``
+          as the sequence of parameters and gives back the rowcount
+
+        ``parameters`` can also be a function that is given the list of results
+        so far and returns the parameters, for statements that need the ids made
+        by the statements before them.
+
+        If ``transaction`` is ``True`` the statements are ran inside one
+        transaction that gets rolled back if any of them fail.
+
+        Returns a list with a result for each statement.
+        """
+        prepared = _prepare_batch(statements)
+        return await self._post(_run_batch, self._conn, prepared, transaction)
+
+@functools.lru_cache(maxsize=512)
+def _is_read_only(sql):
+    """Guesses if a statement only reads from the database.
+
+    Anything that isn't obviously a read goes to the writer, the readers
+    are also opened with ``query_only`` so a wrong guess errors instead of writing.
+    """
+    words = sql.lstrip(' \t\r\n(').split(None, 1)
+    if not words:
+        return False
+    keyword = words[0].lower()
+    if keyword in ('select', 'values'):
+        return True
+    if keyword == 'with':
+        # common table expressions can be used for writes too
+        upper = sql.upper()
+        return not any(w in upper for w in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE'))
+    return False
+
+class Pool:
+    """A group of :class:`Connection` to the same database.
+
+    Create these with :func:`create_pool`.
+
+    Read-only statements (``SELECT``, ``VALUES`` and read-only ``WITH``)
+    are spread across the reader connections, everything else goes to the
+    single writer connection so writes are still serialized.
+
+    .. note::
+
+        The readers can't see a transaction that hasn't been committed
+        on the writer. Use :attr:`writer` directly when a read has to be
+        inside the transaction.
+    """
+    def __init__(self, writer, readers):
+        self._writer = writer
+        self._readers = readers
+        self._next_reader = itertools.cycle(readers) if readers else None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def writer(self):
+        """The :class:`Connection` used for writes."""
+        return self._writer
+
+    @property
+    def readers(self):
+        """The list of :class:`Connection` used for reads."""
+        return list(self._readers)
+
+    def reader(self):
+        """Gets the next reader :class:`Connection`, falls back to the writer if there are none."""
+        if self._next_reader is None:
+            return self._writer
+        return next(self._next_reader)
+
+    def _route(self, sql):
+        if _is_read_only(sql):
+            return self.reader()
+        return self._writer
+
+    def transaction(self):
+        """Gets a transaction object on the writer."""
+        return self._writer.transaction()
+
+    def cursor(self):
+        """Gets a cursor on the writer. See :meth:`Connection.cursor`."""
+        return self._writer.cursor()
+
+    def execute(self, sql, *parameters):
+        """Same as :meth:`Connection.execute` on either a reader or the writer."""
+        return self._route(sql).execute(sql, *parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        """Same as :meth:`Connection.executemany` on the writer."""
+        return self._writer.executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        """Same as :meth:`Connection.executescript` on the writer."""
+        return self._writer.executescript(sql_script)
+
+    async def fetchone(self, query, *parameters):
+        """Same as :meth:`Connection.fetchone` on either a reader or the writer."""
+        return await self._route(query).fetchone(query, *parameters)
+
+    async def fetchmany(self, query, *parameters, size=None):
+        """Same as :meth:`Connection.fetchmany` on either a reader or the writer."""
+        return await self._route(query).fetchmany(query, *parameters, size=size)
+
+    async def fetchall(self, query, *parameters):
+        """Same as :meth:`Connection.fetchall` on either a reader or the writer."""
+        return await self._route(query).fetchall(query, *parameters)
+
+    async def iterate(self, query, *parameters, size=256):
+        """Same as :meth:`Connection.iterate` on either a reader or the writer."""
+        async for row in self._route(query).iterate(query, *parameters, size=size):
+            yield row
+
+    async def batch(self, statements, *, transaction=False):
+        """Same as :meth:`Connection.batch`.
+
+        Goes to a reader only if every statement is a read and there is no transaction.
+        """
+        if not transaction and all(_is_read_only(s if isinstance(s, str) else s[0]) for s in statements):
+            return await self.reader().batch(statements)
+        return await self._writer.batch(statements, transaction=transaction)
+
+    async def close(self):
+        """Closes the readers and the writer."""
+        await asyncio.gather(*(r.close() for r in self._readers))
+        await self._writer.close()
+
 def _connect_pragmas(db, **kwargs):
     connection = sqlite3.connect(db, **kwargs)
     connection.execute('pragma journal_mode=wal')
@@ -313,7 +739,7 @@ def _connect_pragmas(db, **kwargs):
     connection.row_factory = sqlite3.Row
     return connection
 
-def connect(database, *, init=None, timeout=None, loop=None, **kwargs):
+def connect(database, *, init=None, timeout=None, loop=None, statement_cache_size=128, stats=None, **kwargs):
     """asyncio-compatible version of :func:`sqlite3.connect`.
 
     This can be used as a regular coroutine or in an async-with statement.
@@ -338,9 +764,14 @@ def connect(database, *, init=None, timeout=None, loop=None, **kwargs):
     A special keyword-only parameter named ``init`` can be passed which allows
     one to customize the :class:`sqlite3.Connection` before it is converted
     to a :class:`Connection` object.
+
+    ``statement_cache_size`` is passed to :func:`sqlite3.connect` as
+    ``cached_statements``. ``stats`` can be a :class:`Stats` to record
+    how long each statement takes.
     """
     loop = loop or asyncio.get_event_loop()
-    queue = _Worker(loop=loop)
+    kwargs.setdefault('cached_statements', statement_cache_size)
+    queue = _Worker(loop=loop, stats=stats)
     queue.start()
     def factory(con):
         return Connection(con, queue)
@@ -354,3 +785,66 @@ def connect(database, *, init=None, timeout=None, loop=None, **kwargs):
         new_connect = _connect_pragmas
 
     return _ContextManagerMixin(queue, factory, new_connect, database, timeout=timeout, **kwargs)
+
+
+class _PoolContextManager:
+    def __init__(self, database, readers, init, timeout, loop, kwargs):
+        self.database = database
+        self.readers = readers
+        self.init = init
+        self.timeout = timeout
+        self.loop = loop
+        self.kwargs = kwargs
+        self._pool = None
+
+    async def _runner(self):
+        kwargs = self.kwargs
+        # the writer goes first since it switches the database to WAL
+        writer = await connect(self.database, init=self.init, timeout=self.timeout, loop=self.loop, **kwargs)
+
+        def reader_init(con):
+            if self.init is not None:
+                self.init(con)
+            con.execute('pragma query_only=ON')
+
+        try:
+            readers = await asyncio.gather(*(
+                connect(self.database, init=reader_init, timeout=self.timeout, loop=self.loop, **kwargs)
+                for _ in range(self.readers)
+            ))
+        except Exception:
+            await writer.close()
+            raise
+
+        self._pool = Pool(writer, readers)
+        return self._pool
+
+    def __await__(self):
+        return self._runner().__await__()
+
+    async def __aenter__(self):
+        return await self._runner()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._pool is not None:
+            await self._pool.close()
+
+def create_pool(database, *, readers=2, init=None, timeout=None, loop=None, **kwargs):
+    """Creates a :class:`Pool` with one writer and ``readers`` reader connections.
+
+    Much like :func:`connect` this can be used as both a coroutine
+    and an asynchronous context manager.
+
+    .. code-block:: python3
+
+        async with create_pool("bot.db", readers=4) as pool:
+            rows = await pool.fetchall("SELECT * FROM images")
+
+    This relies on WAL mode so readers don't block the writer,
+    which means ``database`` has to be a file and not ``:memory:``.
+    """
+    if database == ':memory:':
+        raise ValueError('create_pool needs a database file, not :memory:')
+    if readers < 0:
+        raise ValueError('readers cannot be negative')
+    return _PoolContextManager(database, readers, init, timeout, loop, kwargs)
@@ -0,0 +1,47 @@
+"""
+Created by catzoo
+Description: Measures the memory of a loaded ImageCatalog at 100k and 1M images
+    Run from the bot's folder:
+        python bench/catalog_memory.py [count ...]
+"""
+import sys
+import time
+import asyncio
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from catalog import ImageCatalog
+import image_tables
+
+guild_id = 1
+
+
+async def measure(count):
+    with tempfile.TemporaryDirectory() as folder:
+        pool = await image_tables.create_pool(f'{folder}/image.db')
+        try:
+            await image_tables.fill(pool, guild_id, count)
+            catalog = ImageCatalog(guild_id)
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            await catalog.load(pool)
+            elapsed = time.perf_counter() - start
+            # whats left after loading is the catalog itself
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        finally:
+            await pool.close()
+    print(f'{len(catalog):>8} images: {used / 1e6:7.1f} MB ({used / count:.0f} bytes each), loaded in {elapsed:.1f}s')
+
+
+async def main(counts):
+    for count in counts:
+        await measure(count)
+
+
+if __name__ == '__main__':
+    asyncio.run(main([int(x) for x in sys.argv[1:]] or [100000, 1000000]))
@@ -0,0 +1,50 @@
+"""
+Created by catzoo
+Description: Benchmarks Checks._main_check for members with 1, 50 and 250 roles
+    Run from the bot's folder (checks.py loads the .env like the bot does):
+        python bench/check_latency.py
+"""
+import sys
+import time
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from checks import Checks
+
+guild_id = 1
+guild_roles = 500  # roles with a level in the guild
+runs = 20000
+
+
+def make_ctx(role_ids):
+    guild = SimpleNamespace(id=guild_id, owner=None)
+    author = SimpleNamespace(id=0, roles=[SimpleNamespace(id=role_id) for role_id in role_ids])
+    return SimpleNamespace(guild=guild, author=author)
+
+
+async def time_check(checks, ctx, level):
+    """Returns the average microseconds of one check"""
+    start = time.perf_counter()
+    for _ in range(runs):
+        await checks._main_check(ctx, level)
+    return (time.perf_counter() - start) / runs * 1e6
+
+
+async def main():
+    checks = Checks()  # not created, the check only uses the roles in memory
+    checks.roles[guild_id] = {role_id: 1 for role_id in range(guild_roles)}
+    checks.roles[guild_id][0] = 3
+
+    for count in (1, 50, 250):
+        # no role is high enough, every role gets looked at
+        worst = await time_check(checks, make_ctx(range(guild_roles - count, guild_roles)), 3)
+        # the first role is a manager role
+        best = await time_check(checks, make_ctx(range(count)), 3)
+        print(f'{count:>3} roles: {worst:6.2f} us no match, {best:6.2f} us first role matches')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
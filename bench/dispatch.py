@@ -0,0 +1,49 @@
+"""
+Created by catzoo
+Description: Benchmarks how many messages a second rounds.Dispatcher gets through
+    Run from the bot's folder:
+        python bench/dispatch.py
+"""
+import sys
+import time
+import random
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from catalog import ImageRecord
+from rounds import Round, Dispatcher
+
+rounds = 100  # channels with a round running
+channels = 10000  # channels messages come from
+messages = 200000
+
+
+def make_messages(channel_ids):
+    return [SimpleNamespace(channel=SimpleNamespace(id=random.choice(channel_ids)),
+                            content='Some chat message that is not the answer')
+            for _ in range(messages)]
+
+
+def run(dispatcher, batch):
+    start = time.perf_counter()
+    for message in batch:
+        dispatcher.dispatch(message)
+    return len(batch) / (time.perf_counter() - start)
+
+
+def main():
+    dispatcher = Dispatcher()
+    for channel_id in range(rounds):
+        image = ImageRecord(channel_id, 'https://example.com/cat.png', 'Cat', answers=('cat',))
+        dispatcher.add(Round(SimpleNamespace(id=channel_id), image, refresh='pof?refresh'))
+
+    print(f'{rounds} rounds running')
+    print(f'random channels: {run(dispatcher, make_messages(range(channels))):,.0f} messages/s')
+    # every message gets normalized and checked against the answers
+    print(f'round channels only: {run(dispatcher, make_messages(range(rounds))):,.0f} messages/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+Created by catzoo
+Description: The images and answers tables the benchmarks fill, same as cog/image.py after its migrations
+"""
+import asqlite
+from catalog import normalize
+
+tables = [
+    "CREATE TABLE images (img_id integer NOT NULL PRIMARY KEY, url text, name text, sha256 text, phash integer, "
+    "guild_id integer)",
+    "CREATE INDEX images_guild ON images (guild_id, img_id)",
+    "CREATE TABLE answers (image_id integer NOT NULL REFERENCES images (img_id) ON DELETE CASCADE, "
+    "normalized_text text NOT NULL, PRIMARY KEY (image_id, normalized_text)) WITHOUT ROWID",
+    "CREATE INDEX answers_text ON answers (normalized_text)",
+]
+
+
+def database_init(connection):
+    connection.create_function('normalize', 1, normalize, deterministic=True)
+
+
+async def create_pool(location):
+    """Returns a asqlite.Pool with the tables made"""
+    pool = await asqlite.create_pool(location, readers=1, init=database_init)
+    await pool.batch(tables, transaction=True)
+    return pool
+
+
+async def fill(pool, guild_id, count):
+    """Adds count images (about 50 character urls) each with one answer"""
+    await pool.executemany("INSERT INTO images (guild_id, url, name) VALUES (?, ?, ?)",
+                           ((guild_id, f'https://cdn.discordapp.com/attachments/1234567/{i}.png', f'image {i}')
+                            for i in range(count)))
+    await pool.execute("INSERT INTO answers SELECT img_id, normalize(name) FROM images WHERE guild_id=?", (guild_id))
@@ -0,0 +1,49 @@
+"""
+Created by catzoo
+Description: Measures ImageCatalog.add_many throughput, the database part of import_images
+    Checking the urls goes over the network and isn't included
+    Run from the bot's folder:
+        python bench/import_rows.py [rows ...]
+"""
+import sys
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from catalog import ImageCatalog
+import image_tables
+
+guild_id = 1
+
+
+async def measure(rows):
+    images = [(f'https://cdn.discordapp.com/attachments/1234567/{i}.png', f'Image {i}', None, None)
+              for i in range(rows)]
+    with tempfile.TemporaryDirectory() as folder:
+        pool = await image_tables.create_pool(f'{folder}/image.db')
+        try:
+            catalog = ImageCatalog(guild_id)
+            start = time.perf_counter()
+            records = await catalog.add_many(pool, images)
+            elapsed = time.perf_counter() - start
+
+            # making sure every answer went to its image
+            reloaded = ImageCatalog(guild_id)
+            await reloaded.load(pool)
+            if any(reloaded.get(record.img_id).answers != record.answers for record in records):
+                raise AssertionError('answers were added to the wrong images')
+        finally:
+            await pool.close()
+    print(f'{rows:>6} rows: {elapsed:.3f}s, {rows / elapsed:,.0f} rows/s')
+
+
+async def main(counts):
+    for rows in counts:
+        await measure(rows)
+
+
+if __name__ == '__main__':
+    asyncio.run(main([int(x) for x in sys.argv[1:]] or [10000]))
@@ -0,0 +1,49 @@
+"""
+Created by catzoo
+Description: Compares the peak memory of streaming a images table with iterate()
+    against loading it with fetchall()
+    Run from the bot's folder, rows defaults to 1000000:
+        python bench/iterate_memory.py [rows]
+"""
+import sys
+import time
+import asyncio
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import asqlite
+
+chunk = 1000  # rows per fetchmany when iterating
+
+
+async def main(rows):
+    with tempfile.TemporaryDirectory() as folder:
+        async with asqlite.create_pool(f'{folder}/image.db') as pool:
+            await pool.execute("CREATE TABLE images (img_id integer NOT NULL PRIMARY KEY, url text, name text)")
+            await pool.executemany("INSERT INTO images (url, name) VALUES (?, ?)",
+                                   ((f'https://cdn.discordapp.com/attachments/1234567/{i}.png', f'name {i}')
+                                    for i in range(rows)))
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            count = 0
+            async for _ in pool.iterate("SELECT * FROM images", size=chunk):
+                count += 1
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            print(f'iterate({chunk}): {count} rows in {elapsed:.2f}s, peak {peak / 1e6:.1f} MB')
+
+            tracemalloc.reset_peak()
+            start = time.perf_counter()
+            count = len(await pool.fetchall("SELECT * FROM images"))
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            print(f'fetchall: {count} rows in {elapsed:.2f}s, peak {peak / 1e6:.1f} MB')
+            tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000))
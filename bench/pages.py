@@ -0,0 +1,55 @@
+"""
+Created by catzoo
+Description: Benchmarks the page builders in page.py
+    - Page with 10 MB of text (short lines and one 5 MB line)
+    - EmbedPage with 50k fields of up to 3000 characters
+    The pages are checked against Discord's limits
+    Run from the bot's folder:
+        python bench/pages.py
+"""
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from page import Page, EmbedPage
+
+fields = 50000
+
+
+def text_pages():
+    start = time.perf_counter()
+    builder = Page()
+    for _ in range(100000):
+        builder.add_line('y' * 49)  # 50 characters with the new line
+    builder.add_line('z' * 5000000)
+    pages = builder.pages()
+    elapsed = time.perf_counter() - start
+
+    if max(len(p) for p in pages) > 2000:
+        raise AssertionError('a page is over 2000 characters')
+    print(f'10 MB of text: {elapsed:.3f}s, {len(pages)} pages')
+
+
+def embed_pages():
+    values = ['v' * random.randint(0, 3000) for _ in range(fields)]
+    start = time.perf_counter()
+    builder = EmbedPage()
+    for number, value in enumerate(values):
+        builder.add_field(f'field {number}', value)
+    pages = builder.pages()
+    elapsed = time.perf_counter() - start
+
+    for embed in pages:
+        if len(embed.fields) > 25 or any(len(f.value) > 1024 for f in embed.fields):
+            raise AssertionError('a embed has too many fields or a field is too long')
+        if sum(len(f.name) + len(f.value) for f in embed.fields) > 6000:
+            raise AssertionError('a embed is over 6000 characters')
+    print(f'{fields} fields: {elapsed:.3f}s, {len(pages)} embeds')
+
+
+if __name__ == '__main__':
+    text_pages()
+    embed_pages()
@@ -0,0 +1,57 @@
+"""
+Created by catzoo
+Description: Benchmarks phash.HashIndex lookups against a linear scan at 100k hashes
+    The results are checked against the linear scan
+    Run from the bot's folder:
+        python bench/phash_lookup.py [count]
+"""
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from phash import HashIndex, distance
+
+max_distance = 7
+lookups = 1000
+checked = 50  # lookups also ran as a linear scan
+
+
+def near(h):
+    """h with a few random bits flipped"""
+    flip = 0
+    for bit in random.sample(range(64), random.randint(0, max_distance + 2)):
+        flip |= 1 << bit
+    return h ^ flip
+
+
+def linear(hashes, h):
+    return sorted(i for i, x in enumerate(hashes) if distance(x, h) <= max_distance)
+
+
+def main(count):
+    hashes = [random.getrandbits(64) for _ in range(count)]
+    index = HashIndex(max_distance)
+    start = time.perf_counter()
+    for i, h in enumerate(hashes):
+        index.add(h, i)
+    print(f'{count} hashes indexed in {time.perf_counter() - start:.2f}s')
+
+    queries = [near(random.choice(hashes)) for _ in range(lookups)]
+    start = time.perf_counter()
+    for h in queries:
+        index.search(h)
+    print(f'HashIndex: {(time.perf_counter() - start) / lookups * 1000:.3f} ms per lookup')
+
+    start = time.perf_counter()
+    for h in queries[:checked]:
+        expected = linear(hashes, h)
+        if expected != sorted(i for _, i in index.search(h)):
+            raise AssertionError(f'HashIndex missed hashes near {h:016x}')
+    print(f'linear scan: {(time.perf_counter() - start) / checked * 1000:.3f} ms per lookup, same results')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,106 @@
+"""
+Created by catzoo
+Description: Round start latency with a local image (uploaded from image_store) vs a remote url
+    Runs against two stand-in servers on loopback, standard library only:
+        - a image host, waits rtt before answering like a remote CDN would
+        - Discord's create message, a embed url is fetched before it answers
+          (the image only shows once Discord has it), a upload is only read
+    Loopback has no bandwidth limit, on a real link the upload also costs the bot's uplink time
+    Run from the bot's folder, rtt is in ms and defaults to 40:
+        python bench/round_start.py [rtt]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import tempfile
+import threading
+import statistics
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sizes = [200 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+runs = 30
+images = {str(size): os.urandom(size) for size in sizes}
+rtt = 0.04
+
+
+class ImageHost(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(rtt)  # connecting + the first byte from a remote host
+        data = images[self.path.strip('/')]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Discord(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers['Content-Type'].startswith('application/json'):
+            url = json.loads(body)['embeds'][0]['image']['url']
+            urllib.request.urlopen(url).read()
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+
+def serve(handler):
+    """Starts the server in a thread, returns its url"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def send_remote(discord, host, name, folder):
+    body = json.dumps({'embeds': [{'image': {'url': f'{host}/{name}'}}]}).encode()
+    request = urllib.request.Request(f'{discord}/', body, {'Content-Type': 'application/json'})
+    urllib.request.urlopen(request).read()
+
+
+def send_local(discord, host, name, folder):
+    boundary = uuid.uuid4().hex
+    with open(f'{folder}/{name}.png', 'rb') as f:
+        data = f.read()
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="payload_json"\r\n\r\n{{}}\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="image.png"\r\n\r\n').encode()
+    body += data + f'\r\n--{boundary}--\r\n'.encode()
+    request = urllib.request.Request(f'{discord}/', body,
+                                     {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    urllib.request.urlopen(request).read()
+
+
+def main():
+    host = serve(ImageHost)
+    discord = serve(Discord)
+    with tempfile.TemporaryDirectory() as folder:
+        for name, data in images.items():
+            with open(f'{folder}/{name}.png', 'wb') as f:
+                f.write(data)
+
+        for size in sizes:
+            for kind, send in (('remote', send_remote), ('local', send_local)):
+                send(discord, host, str(size), folder)  # warming up the connection
+                times = []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    send(discord, host, str(size), folder)
+                    times.append((time.perf_counter() - start) * 1000)
+                times.sort()
+                print(f'rtt {rtt * 1000:.0f} ms, {size // 1024:5} KB {kind:6}: '
+                      f'p50 {statistics.median(times):6.1f} ms, p90 {times[int(runs * 0.9) - 1]:6.1f} ms')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        rtt = float(sys.argv[1]) / 1000
+    main()
@@ -0,0 +1,46 @@
+"""
+Created by catzoo
+Description: Benchmarks the asqlite worker thread
+    - post -> result latency of one hop to the worker
+    - CPU used by idle connections
+    - how long close() takes
+    Run from the bot's folder:
+        python bench/worker.py
+"""
+import sys
+import time
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import asqlite
+
+hops = 20000
+idle_connections = 20
+idle_seconds = 2
+
+
+async def main():
+    conn = await asqlite.connect(':memory:')
+
+    start = time.perf_counter()
+    for _ in range(hops):
+        await conn._post(int)  # nothing to run, only the trip there and back
+    print(f'post -> result: {(time.perf_counter() - start) / hops * 1e6:.1f} us per hop')
+
+    idle = [await asqlite.connect(':memory:') for _ in range(idle_connections)]
+    cpu = time.process_time()
+    await asyncio.sleep(idle_seconds)
+    cpu = time.process_time() - cpu
+    print(f'{idle_connections} idle connections: {cpu * 1000:.2f} ms CPU over {idle_seconds}s')
+
+    start = time.perf_counter()
+    await conn.close()
+    print(f'close: {(time.perf_counter() - start) * 1000:.2f} ms')
+    for c in idle:
+        await c.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
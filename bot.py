@@ -26,17 +26,10 @@ bot.load_extension('jishaku')
 
 
 @bot.check
-async def correct_guild_only(ctx):
+async def guild_only(ctx):
+    # every guild gets its own images, points and roles, so DMs don't have anything to use
     if ctx.guild:
-        if ctx.guild.id == env_config.main_guild:
-            return True
-        else:
-            name = bot.get_guild(env_config.main_guild)
-            name = name.name
-            await ctx.send(embed=discord.Embed(title='Sorry!',
-                                               description='This bot can only handle one guild. '
-                                                           'This is currently set to: '
-                                                           f'{name}'))
+        return True
     else:
         raise commands.NoPrivateMessage()
 
@@ -0,0 +1,284 @@
+"""
+Created by catzoo
+Description: In memory helpers for picking random images / channels
+"""
+import random
+import unicodedata
+
+from phash import HashIndex, to_signed, to_unsigned
+
+
+def normalize(text):
+    """Makes answers comparable: casefolded, accents stripped (NFKD), punctuation removed
+    and whitespace collapsed
+    Example: '  Café,   Olé! ' -> 'cafe ole'"""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c) and not unicodedata.category(c).startswith('P'))
+    return ' '.join(text.split())
+
+
+class RandomSet:
+    """
+    A set that can also give back a random item
+    Use:
+        - add(item) / discard(item)
+            - O(1), the last item gets swapped into the removed spot
+        - choice()
+            - O(1), picks a random item. Returns None if empty
+
+    Items have to be hashable
+    """
+    __slots__ = ('_items', '_positions')
+
+    def __init__(self, items=()):
+        self._items = []  # the items, in no order
+        self._positions = {}  # item: index in self._items
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._positions
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def add(self, item):
+        if item not in self._positions:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item):
+        position = self._positions.pop(item, None)
+        if position is None:
+            return
+        last = self._items.pop()
+        if position != len(self._items):
+            # moving the last item into the removed item's spot
+            self._items[position] = last
+            self._positions[last] = position
+
+    def clear(self):
+        self._items.clear()
+        self._positions.clear()
+
+    def choice(self):
+        if not self._items:
+            return None
+        return self._items[random.randrange(len(self._items))]
+
+
+class ImageRecord:
+    """One row of the images table
+    sha256 is the hash of the local copy (see image_store), None if there isn't one
+    phash is the perceptual hash (unsigned), None if it hasn't been made
+    answers is a tuple of the normalized answers (see normalize), same as the answers table"""
+    __slots__ = ('img_id', 'url', 'name', 'sha256', 'phash', 'answers')
+
+    def __init__(self, img_id, url, name, sha256=None, phash=None, answers=()):
+        self.img_id = img_id
+        self.url = url
+        self.name = name
+        self.sha256 = sha256
+        self.phash = phash
+        self.answers = tuple(answers)
+
+
+class ImageCatalog:
+    """
+    In memory copy of one guild's rows in the images table
+    Use:
+        - load(pool)
+            - Reads the whole table once (streamed)
+        - add(pool, url, name) / add_many(pool, images) / remove(pool, img_id)
+            - Writes to the database, then updates the catalog
+        - discard(img_id)
+            - Only removes it from the catalog, for when the row was
+              already deleted (example: in a batch)
+        - get(img_id) / random(exclude) / iteration
+            - Served from memory, iterates in img_id order
+        - duplicates(phash)
+            - Images that look the same (see phash.HashIndex)
+        - set_hashes(pool, hashes)
+            - Saves perceptual hashes of images that didn't have one
+        - add_answer(pool, img_id, text) / remove_answer(pool, img_id, text)
+            - Changes the answers of a image, the text gets normalized
+        - with_answer(pool, text)
+            - The img_ids of the images that have the answer
+
+    New images get their normalized name as the answer
+    """
+    __slots__ = ('guild_id', '_images', '_ids', '_hashes')
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self._images = {}  # img_id: ImageRecord, kept in img_id order
+        self._ids = RandomSet()
+        self._hashes = HashIndex()  # phash: img_id
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, img_id):
+        return img_id in self._images
+
+    def __iter__(self):
+        return iter(self._images.values())
+
+    def _put(self, record):
+        self._images[record.img_id] = record
+        if record.answers:
+            # images without answers can't be won, so they never get picked
+            self._ids.add(record.img_id)
+        if record.phash is not None:
+            self._hashes.add(record.phash, record.img_id)
+
+    async def load(self, pool):
+        self._images.clear()
+        self._ids.clear()
+        self._hashes = HashIndex()
+        async for row in pool.iterate("SELECT img_id, url, name, sha256, phash FROM images WHERE guild_id=? "
+                                      "ORDER BY img_id", (self.guild_id), size=1000):
+            phash = to_unsigned(row[4]) if row[4] is not None else None
+            self._put(ImageRecord(row[0], row[1], row[2], row[3], phash))
+        answers = {}  # img_id: [normalized_text]
+        async for row in pool.iterate("SELECT image_id, normalized_text FROM answers "
+                                      "JOIN images ON img_id=image_id WHERE guild_id=?", (self.guild_id),
+                                      size=1000):
+            answers.setdefault(row[0], []).append(row[1])
+        for img_id, texts in answers.items():
+            record = self._images.get(img_id)
+            if record is not None:
+                record.answers = tuple(texts)
+                self._ids.add(img_id)
+
+    async def add(self, pool, url, name, sha256=None, phash=None):
+        """Adds the image to the database and the catalog
+        Returns the ImageRecord"""
+        signed = to_signed(phash) if phash is not None else None
+        answers = self._name_answers(name)
+        results = await pool.batch([
+            ("INSERT INTO images (guild_id, url, name, sha256, phash) VALUES (?, ?, ?, ?, ?)",
+             (self.guild_id, url, name, sha256, signed), 'lastrowid'),
+            ("INSERT INTO answers (image_id, normalized_text) VALUES (last_insert_rowid(), ?)",
+             [(x,) for x in answers], 'executemany'),
+        ], transaction=True)
+        record = ImageRecord(results[0], url, name, sha256, phash, answers)
+        self._put(record)
+        return record
+
+    async def add_many(self, pool, images):
+        """Adds many images in one transaction
+        images is a list of (url, name, sha256, phash), returns the ImageRecords in the same order"""
+        if not images:
+            return []
+        rows = [(self.guild_id, url, name, sha256, to_signed(phash) if phash is not None else None)
+                for url, name, sha256, phash in images]
+        answers = [self._name_answers(name) for _, name, _, _ in images]
+        # every image gives back its own img_id, then all the answers go in with one executemany
+        insert = "INSERT INTO images (guild_id, url, name, sha256, phash) VALUES (?, ?, ?, ?, ?)"
+        statements = [(insert, row, 'lastrowid') for row in rows]
+        statements.append(("INSERT INTO answers (image_id, normalized_text) VALUES (?, ?)",
+                           lambda img_ids: [(img_id, x) for img_id, texts in zip(img_ids, answers) for x in texts],
+                           'executemany'))
+        img_ids = (await pool.batch(statements, transaction=True))[:-1]
+        records = []
+        for img_id, (url, name, sha256, phash), texts in zip(img_ids, images, answers):
+            record = ImageRecord(img_id, url, name, sha256, phash, texts)
+            self._put(record)
+            records.append(record)
+        return records
+
+    async def remove(self, pool, img_id):
+        """Removes the image from the database and the catalog
+        Returns False if the image doesn't exist"""
+        if img_id not in self._images:
+            return False
+        await pool.execute("DELETE FROM images WHERE img_id=?", (img_id))
+        self.discard(img_id)
+        return True
+
+    def discard(self, img_id):
+        record = self._images.pop(img_id, None)
+        self._ids.discard(img_id)
+        if record is not None and record.phash is not None:
+            self._hashes.remove(record.phash, img_id)
+
+    def duplicates(self, phash):
+        """Returns [(distance, ImageRecord)] of the images that look the same, closest first"""
+        return [(d, self._images[img_id]) for d, img_id in self._hashes.search(phash)]
+
+    async def set_hashes(self, pool, hashes):
+        """hashes is {img_id: phash}, saved in one transaction"""
+        hashes = {img_id: value for img_id, value in hashes.items() if img_id in self._images}
+        if not hashes:
+            return
+        await pool.batch([("UPDATE images SET phash=? WHERE img_id=?",
+                           [(to_signed(value), img_id) for img_id, value in hashes.items()], 'executemany')],
+                         transaction=True)
+        for img_id, value in hashes.items():
+            record = self._images[img_id]
+            if record.phash is not None:
+                self._hashes.remove(record.phash, img_id)
+            record.phash = value
+            self._hashes.add(value, img_id)
+
+    @staticmethod
+    def _name_answers(name):
+        text = normalize(name) if name else ''
+        return (text,) if text else ()
+
+    async def add_answer(self, pool, img_id, text):
+        """Adds a answer to the image
+        Returns the normalized answer, None if the image doesn't exist or the answer is empty"""
+        record = self._images.get(img_id)
+        text = normalize(text)
+        if record is None or not text:
+            return None
+        await pool.execute("INSERT OR IGNORE INTO answers (image_id, normalized_text) VALUES (?, ?)",
+                           (img_id, text))
+        if text not in record.answers:
+            record.answers += (text,)
+            self._ids.add(img_id)
+        return text
+
+    async def remove_answer(self, pool, img_id, text):
+        """Removes a answer from the image
+        Returns False if the image doesn't have that answer
+        Raises ValueError if its the image's last answer"""
+        record = self._images.get(img_id)
+        text = normalize(text)
+        if record is None or text not in record.answers:
+            return False
+        if len(record.answers) == 1:
+            raise ValueError("can't remove the last answer")
+        await pool.execute("DELETE FROM answers WHERE image_id=? AND normalized_text=?", (img_id, text))
+        record.answers = tuple(x for x in record.answers if x != text)
+        return True
+
+    async def with_answer(self, pool, text):
+        """Returns the img_ids of the images that have the answer (uses the answers_text index)"""
+        rows = await pool.fetchall("SELECT image_id FROM answers JOIN images ON img_id=image_id "
+                                   "WHERE normalized_text=? AND guild_id=? ORDER BY image_id",
+                                   (normalize(text), self.guild_id))
+        return [row[0] for row in rows]
+
+    def get(self, img_id):
+        return self._images.get(img_id)
+
+    def random(self, exclude=()):
+        """Returns a random ImageRecord that isn't in exclude (img_ids), None if there aren't any
+        Images without answers are never picked"""
+        # a few random tries, exclude should be a lot smaller than the catalog
+        for _ in range(8):
+            img_id = self._ids.choice()
+            if img_id is None:
+                return None
+            if img_id not in exclude:
+                return self._images[img_id]
+        for img_id in self._ids:
+            if img_id not in exclude:
+                return self._images[img_id]
+        return None
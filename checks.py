@@ -3,6 +3,7 @@ Created by catzoo
 Description: Discord.py role checks
 """
 import os
+import asyncio
 import asqlite
 import env_config
 
@@ -27,9 +28,17 @@ class Checks:
             - Checks for level 1 roles / user check
 
     This will store roles in SQLite databases (location depending on env_config)
+    Only one Checks is made for the whole bot (see Checks.get()), the roles
+    are kept in memory so the checks don't have to go to the database
+
+    Roles belong to a guild, the role functions take the guild's id
     """
+    _instance = None  # the Checks used by the discord.py checks
+    _lock = None  # makes sure only one Checks gets created
+
     def __init__(self):
         self.connection = None
+        self.roles = {}  # guild_id: {role_id: level}, same as the roles table
 
     @classmethod
     async def create(cls):
@@ -46,9 +55,45 @@ class Checks:
             conn = await asqlite.connect(location)
 
         self.connection = conn
+        if (await conn.fetchone("PRAGMA user_version"))[0] < 1:
+            # roles from before there was more than one guild belong to GUILD (0 if its not set)
+            await conn.batch([
+                "CREATE TABLE roles_new (guild_id integer NOT NULL, role_id integer NOT NULL, level integer, "
+                "PRIMARY KEY (guild_id, role_id))",
+                ("INSERT OR IGNORE INTO roles_new SELECT ?, role_id, level FROM roles",
+                 (env_config.main_guild or 0)),
+                "DROP TABLE roles",
+                "ALTER TABLE roles_new RENAME TO roles",
+                "PRAGMA user_version = 1",
+            ], transaction=True)
+
+        # loading the roles once, add_role / remove_role will keep it updated
+        for row in await conn.fetchall("SELECT guild_id, role_id, level FROM roles"):
+            self.roles.setdefault(row[0], {})[row[1]] = row[2]
 
         return self
 
+    @classmethod
+    async def get(cls):
+        """Returns the Checks used by the whole bot
+        Creates it the first time this is called"""
+        if cls._instance is None:
+            if cls._lock is None:
+                cls._lock = asyncio.Lock()
+            async with cls._lock:
+                # another check might of created it while we were waiting
+                if cls._instance is None:
+                    cls._instance = await cls.create()
+        return cls._instance
+
+    async def close(self):
+        """Closes the database connection"""
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+        if Checks._instance is self:
+            Checks._instance = None
+
     async def get_cursor(self):
         """Created this for use for most functions
         But can be used to execute commands to the database if needed"""
@@ -56,38 +101,41 @@ class Checks:
             raise NoDatabase('Checks is not created!')
         return await self.connection.cursor()
 
-    async def add_role(self, role_id, level):
+    async def add_role(self, guild_id, role_id, level):
         """Adds the role to the database."""
         c = await self.get_cursor()
-        await c.execute("INSERT INTO roles VALUES (?,?)", (role_id, level))
+        await c.execute("INSERT INTO roles VALUES (?,?,?)", (guild_id, role_id, level))
+        self.roles.setdefault(guild_id, {})[role_id] = level
 
-    async def remove_role(self, role_id):
+    async def remove_role(self, guild_id, role_id):
         """Removes the role from the database."""
         c = await self.get_cursor()
-        await c.execute("DELETE FROM roles WHERE role_id=?", (role_id))
-
-    async def get_role(self, role_id):
-        """Returns the role from the database.
+        await c.execute("DELETE FROM roles WHERE guild_id=? AND role_id=?", (guild_id, role_id))
+        roles = self.roles.get(guild_id)
+        if roles is not None:
+            roles.pop(role_id, None)
+            if not roles:
+                del self.roles[guild_id]
+
+    async def get_role(self, guild_id, role_id):
+        """Returns the role (role_id, level).
         Might return None if it doesn't exist"""
-        c = await self.get_cursor()
-        await c.execute("SELECT * FROM roles WHERE role_id=?", (role_id))
-
-        return await c.fetchone()
-
-    async def get_all_roles(self):
-        """Returns all the roles from the database
-        Might return None if there aren't any"""
-        c = await self.get_cursor()
-        await c.execute("SELECT * FROM roles")
-
-        return await c.fetchall()
-
-    async def _role_check(self, role_id, level):
-        """Checks if the role is in the database with correct level"""
+        level = self.roles.get(guild_id, {}).get(role_id)
+        if level is None:
+            return None
+        return (role_id, level)
+
+    async def get_all_roles(self, guild_id):
+        """Returns all the guild's roles as a list of (role_id, level)
+        Might be empty if there aren't any"""
+        return list(self.roles.get(guild_id, {}).items())
+
+    async def _role_check(self, guild_id, role_id, level):
+        """Checks if the role is added with correct level"""
         been_check = False
-        role = await self.get_role(role_id)
-        if role:
-            if role[1] >= level:
+        role_level = self.roles.get(guild_id, {}).get(role_id)
+        if role_level is not None:
+            if role_level >= level:
                 been_check = True
 
         return been_check
@@ -104,42 +152,41 @@ class Checks:
         return been_check
 
     async def _main_check(self, ctx, level):
-        """Uses both _role_check and _user_check"""
-        allow = False  # saying if the check passed or not
-
-        c = await self.get_cursor()
-        await c.execute("SELECT * FROM roles")
-
+        """Uses both the role levels and _user_check"""
         if await self._user_check(ctx):
-            allow = True
-        else:
-            for r in ctx.author.roles:
-                if await self._role_check(r.id, level):
-                    allow = True
-
-        return allow
+            return True
+
+        roles = self.roles.get(ctx.guild.id)
+        if not roles:
+            return False
+        # stopping at the first role that has a high enough level
+        for r in ctx.author.roles:
+            role_level = roles.get(r.id)
+            if role_level is not None and role_level >= level:
+                return True
+        return False
 
     @staticmethod
     async def developer_check(ctx):
         """Highest level check.
         Only checks for the developer or guild owner"""
-        self = await Checks.create()
+        self = await Checks.get()
         return await self._user_check(ctx)
 
     @staticmethod
     async def manager_check(ctx):
         """Level 3 of role / user checking"""
-        self = await Checks.create()
+        self = await Checks.get()
         return await self._main_check(ctx, 3)
 
     @staticmethod
     async def moderator_check(ctx):
         """Level 2 of role / user checking"""
-        self = await Checks.create()
+        self = await Checks.get()
         return await self._main_check(ctx, 2)
 
     @staticmethod
     async def user_check(ctx):
         """Level 1 of role / user checking"""
-        self = await Checks.create()
+        self = await Checks.get()
         return await self._main_check(ctx, 1)
\ No newline at end of file
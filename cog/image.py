@@ -3,21 +3,129 @@ created by catzoo
 created on 11/9/2019
 """
 import os
+import io
+import csv
+import json
 import typing
+import asyncio
+import functools
+from pathlib import Path
 
-from datetime import datetime
-from datetime import timedelta
+from datetime import datetime, timezone as dt_timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
+import aiohttp
 import discord
-from discord.ext import tasks, commands
+from discord.ext import commands
 
 import env_config
 import asqlite
-from random import randint
 from checks import Checks
+from catalog import normalize
+from guilds import GuildState, GuildStates
+from rounds import Round
+from scheduler import Slot, Scheduler
+from validator import ImageValidator
+from image_store import ImageStore, TooBig
+import phash
 import page
 
 __cog_name__ = 'image'
+database_readers = 2  # reader connections in the database pool
+leaderboard_size = 10  # users per page for top / leaderboard
+max_download = 8 * 1024 * 1024  # biggest image downloaded to make the perceptual hash
+import_concurrency = 8  # images downloaded at once by import_images
+guild_idle = 30 * 60  # seconds a guild's images / channels stay in memory after it was last used
+# guild that the rows from before multi guild support get, 0 if GUILD isn't set
+legacy_guild = env_config.main_guild or 0
+
+# gives a user a point in a guild (adding them if needed) and returns their new points
+add_point = ("INSERT INTO users (guild_id, user_id, points) VALUES (?, ?, 1) "
+             "ON CONFLICT(guild_id, user_id) DO UPDATE SET points=points + 1 RETURNING points")
+
+
+def database_init(connection):
+    """Ran on every database connection, lets the SQL use normalize() (see catalog.normalize)"""
+    connection.create_function('normalize', 1, normalize, deterministic=True)
+
+
+# database upgrades, ran in order. The database's user_version is how many have been ran
+migrations = [
+    # 1 - users gets a primary key, and an index for the leaderboard
+    [
+        "CREATE TABLE users_new (user_id integer NOT NULL PRIMARY KEY, points integer NOT NULL DEFAULT 0)",
+        "INSERT INTO users_new SELECT user_id, max(coalesce(points, 0)) FROM users GROUP BY user_id",
+        "DROP TABLE users",
+        "ALTER TABLE users_new RENAME TO users",
+        "CREATE INDEX users_points ON users (points, user_id)",
+    ],
+    # 2 - ignore gets a primary key so it can be bulk inserted with INSERT OR IGNORE
+    [
+        "CREATE TABLE ignore_new (channel_id integer NOT NULL PRIMARY KEY)",
+        "INSERT OR IGNORE INTO ignore_new SELECT channel_id FROM ignore",
+        "DROP TABLE ignore",
+        "ALTER TABLE ignore_new RENAME TO ignore",
+    ],
+    # 3 - round schedule, starting with the old hard coded 17:30 every day
+    [
+        "CREATE TABLE schedule (slot_id integer NOT NULL PRIMARY KEY, hour integer, minute integer, "
+        "interval integer, timezone text, catch_up integer NOT NULL DEFAULT 0, last_run real)",
+        "INSERT INTO schedule (hour, minute) VALUES (17, 30)",
+    ],
+    # 4 - hash of the local copy of the image (image_store)
+    [
+        "ALTER TABLE images ADD COLUMN sha256 text",
+    ],
+    # 5 - perceptual hash, to find the same picture added twice
+    [
+        "ALTER TABLE images ADD COLUMN phash integer",
+    ],
+    # 6 - answers, a image can have more than one. Starts with the normalized names
+    [
+        "CREATE TABLE answers (image_id integer NOT NULL REFERENCES images (img_id) ON DELETE CASCADE, "
+        "normalized_text text NOT NULL, PRIMARY KEY (image_id, normalized_text)) WITHOUT ROWID",
+        "CREATE INDEX answers_text ON answers (normalized_text)",
+        "INSERT OR IGNORE INTO answers SELECT img_id, normalize(name) FROM images "
+        "WHERE name IS NOT NULL AND normalize(name) != ''",
+    ],
+    # 7 - more than one guild, the old rows go to legacy_guild
+    [
+        "ALTER TABLE images ADD COLUMN guild_id integer",
+        ("UPDATE images SET guild_id=?", (legacy_guild)),
+        "CREATE INDEX images_guild ON images (guild_id, img_id)",
+        "CREATE TABLE users_new (guild_id integer NOT NULL, user_id integer NOT NULL, "
+        "points integer NOT NULL DEFAULT 0, PRIMARY KEY (guild_id, user_id))",
+        ("INSERT INTO users_new SELECT ?, user_id, points FROM users", (legacy_guild)),
+        "DROP TABLE users",
+        "ALTER TABLE users_new RENAME TO users",
+        "CREATE INDEX users_points ON users (guild_id, points, user_id)",
+        "CREATE TABLE ignore_new (guild_id integer NOT NULL, channel_id integer NOT NULL, "
+        "PRIMARY KEY (guild_id, channel_id))",
+        ("INSERT INTO ignore_new SELECT ?, channel_id FROM ignore", (legacy_guild)),
+        "DROP TABLE ignore",
+        "ALTER TABLE ignore_new RENAME TO ignore",
+        "ALTER TABLE schedule ADD COLUMN guild_id integer",
+        ("UPDATE schedule SET guild_id=?", (legacy_guild)),
+        # without GUILD nobody could see or remove these slots (example: the 17:30 one on a new install)
+        "DELETE FROM schedule WHERE guild_id=0",
+    ],
+    # 8 - normalize() also removes punctuation now. Answers that end up the same (or empty) get dropped
+    [
+        "UPDATE OR IGNORE answers SET normalized_text=normalize(normalized_text)",
+        "DELETE FROM answers WHERE normalized_text != normalize(normalized_text) OR normalized_text = ''",
+    ],
+]
+
+
+class TimeZone(commands.Converter):
+    """Only takes IANA timezone names (example: America/New_York)
+    so schedule daily doesn't take catch_up as the timezone"""
+    async def convert(self, ctx, argument):
+        try:
+            ZoneInfo(argument)
+        except (ZoneInfoNotFoundError, ValueError, OSError):
+            raise commands.BadArgument(f'{argument} is not a timezone')
+        return argument
 
 
 # noinspection PyRedundantParentheses
@@ -28,28 +136,27 @@ class Image(commands.Cog):
         # if we change the cog's name, it would change the database
         self.database_location = f'{env_config.data_folder}/image.db'
         self.ready = False  # used to only make on_ready event run once
-        self.connection = None  # SQLite database
-        self.guild = None  # the main guild. This is grabbed in on_ready() event
-
-        self.channel = None  # the text channel that the image is sent on
-        self.image = None  # SQLite image that we sent
-        self.image_sent = False  # if there is a image sent or not
-        self.loop_started = False  # used to not send a message when the bot starts
-
-    @staticmethod
-    def url_check(url):
-        """Checks if the image url is supported
-            going to expand this a bit more later"""
-        image_formats = [
-            "jpeg", "jpg", "jfif",
-            "tiff", "gif", "bmp",
-            "png", "pnm", "heif", "bpg",
-        ]
-        format_type = url.split('.')[-1]
-        if format_type in image_formats:
-            return True
-        else:
-            return False
+        self.pool = None  # SQLite database, reads are spread across reader connections
+        # statement timings, only recorded if SQL_STATS is set
+        self.stats = asqlite.Stats() if env_config.sql_stats else None
+        # images, ignored channels and rounds of the guilds being used (see guilds.GuildState)
+        self.states = GuildStates(self.load_guild, idle_timeout=guild_idle)
+        self.scheduler = Scheduler(self.scheduled_round)  # starts the rounds, loaded from the schedule table
+        self.validator = ImageValidator()  # checks image urls, shares one http session
+        # local copies of the images, None if IMAGE_STORE_SIZE is 0
+        self.store = None
+        if env_config.image_store_size > 0:
+            self.store = ImageStore(f'{env_config.data_folder}/images', env_config.image_store_size * 1024 * 1024)
+
+    def cog_unload(self):
+        self.scheduler.stop()
+        self.states.stop()
+        self.bot.loop.create_task(self.validator.close())
+
+    async def url_check(self, url):
+        """Checks if the url is a supported image
+        Returns a validator.Result, which is False if it isn't"""
+        return await self.validator.check(url)
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -59,54 +166,332 @@ class Image(commands.Cog):
         if not self.ready:
             if not os.path.exists(self.database_location):
                 # database file is not made, so we will assume the database isn't setup
-                conn = await asqlite.connect(self.database_location)
-                c = await conn.cursor()
-                await c.execute("CREATE TABLE users (user_id integer NOT NULL, points integer)")
-                await c.execute("CREATE TABLE images (img_id integer NOT NULL PRIMARY KEY, url text, name text)")
-                await c.execute("CREATE TABLE ignore (channel_id integer NOT NULL)")
+                pool = await asqlite.create_pool(self.database_location, readers=database_readers,
+                                                 init=database_init, stats=self.stats)
+                await pool.execute("CREATE TABLE users (user_id integer NOT NULL, points integer)")
+                await pool.execute("CREATE TABLE images (img_id integer NOT NULL PRIMARY KEY, url text, name text)")
+                await pool.execute("CREATE TABLE ignore (channel_id integer NOT NULL)")
             else:
-                conn = await asqlite.connect(self.database_location)
+                pool = await asqlite.create_pool(self.database_location, readers=database_readers,
+                                                 init=database_init, stats=self.stats)
             self.ready = True
 
-            self.connection = conn  # database connection
-            self.guild = self.bot.get_guild(env_config.main_guild)
+            self.pool = pool  # database connections
+            await self.upgrade_database()
+            if self.store:
+                await self.bot.loop.run_in_executor(None, self.store.load)
+
+            async for row in pool.iterate("SELECT * FROM schedule"):
+                self.scheduler.add(Slot.from_row(row))
+            self.scheduler.start()
+            self.states.start()  # dropping guilds that aren't being used
+            print('Starting image schedule')
+
+    async def load_guild(self, guild_id):
+        """Loads a guild's state, used by self.states"""
+        state = GuildState(guild_id, rounds=env_config.rounds)
+        await state.load(self.pool, self.bot.get_guild(guild_id))
+        return state
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        # guilds that aren't loaded don't have any rounds
+        state = self.states.peek(message.guild.id) if message.guild else None
+        if state is not None:
+            state.rounds.dispatcher.dispatch(message)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        state = self.states.peek(channel.guild.id)
+        if state is not None:
+            state.update_eligible(channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        state = self.states.peek(channel.guild.id)
+        if state is not None:
+            state.update_eligible(channel, deleted=True)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        state = self.states.peek(after.guild.id)
+        if state is not None:
+            state.update_eligible(after)
 
-            self.image_before_loop.start()
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        # keeping the images and points in case the bot gets added back, its schedule would only error
+        self.states.discard(guild.id)
+        for slot in list(self.scheduler.slots.values()):
+            if slot.guild_id == guild.id:
+                self.scheduler.remove(slot.slot_id)
+        await self.pool.execute("DELETE FROM schedule WHERE guild_id=?", (guild.id))
+
+    async def upgrade_database(self):
+        """Runs the migrations that haven't been ran yet
+        Each one is ran in its own transaction along with the user_version change"""
+        version = (await self.pool.writer.fetchone("PRAGMA user_version"))[0]
+        for number, statements in enumerate(migrations[version:], start=version + 1):
+            print(f'Upgrading {self.database_location} to version {number}')
+            await self.pool.batch([*statements, f"PRAGMA user_version = {number}"], transaction=True)
+
+    async def leaderboard_page(self, guild_id, limit=leaderboard_size, after=None, before=None, last=False):
+        """Returns the guild's users with the most points (user_id, points), using keyset pagination
+        after / before is a (points, user_id), see page.KeysetProvider"""
+        if after is not None:
+            return await self.pool.fetchall("SELECT user_id, points FROM users WHERE guild_id=? "
+                                            "AND (points, user_id) < (?, ?) "
+                                            "ORDER BY points DESC, user_id DESC LIMIT ?", (guild_id, *after, limit))
+        if before is not None:
+            users = await self.pool.fetchall("SELECT user_id, points FROM users WHERE guild_id=? "
+                                             "AND (points, user_id) > (?, ?) "
+                                             "ORDER BY points, user_id LIMIT ?", (guild_id, *before, limit))
+            return users[::-1]
+        if last:
+            users = await self.pool.fetchall("SELECT user_id, points FROM users WHERE guild_id=? "
+                                             "ORDER BY points, user_id LIMIT ?", (guild_id, limit))
+            return users[::-1]
+        return await self.pool.fetchall("SELECT user_id, points FROM users WHERE guild_id=? "
+                                        "ORDER BY points DESC, user_id DESC LIMIT ?", (guild_id, limit))
+
+    async def image_page(self, guild_id, limit, after=None, before=None, last=False):
+        """Returns the guild's images (img_id, url, name) in img_id order, using keyset pagination
+        after / before is a img_id, see page.KeysetProvider"""
+        if after is not None:
+            return await self.pool.fetchall("SELECT img_id, url, name FROM images WHERE guild_id=? AND img_id > ? "
+                                            "ORDER BY img_id LIMIT ?", (guild_id, after, limit))
+        if before is not None or last:
+            # going backwards, then flipping it
+            if before is not None:
+                images = await self.pool.fetchall("SELECT img_id, url, name FROM images "
+                                                  "WHERE guild_id=? AND img_id < ? "
+                                                  "ORDER BY img_id DESC LIMIT ?", (guild_id, before, limit))
+            else:
+                images = await self.pool.fetchall("SELECT img_id, url, name FROM images WHERE guild_id=? "
+                                                  "ORDER BY img_id DESC LIMIT ?", (guild_id, limit))
+            return images[::-1]
+        return await self.pool.fetchall("SELECT img_id, url, name FROM images WHERE guild_id=? "
+                                        "ORDER BY img_id LIMIT ?", (guild_id, limit))
+
+    @staticmethod
+    def leaderboard_lines(guild, users, start=1):
+        """Makes the leaderboard text, start is the rank of the first user"""
+        string = ''
+        for k, x in enumerate(users, start=start):
+            # 0 - ID, 1 - Points
+            member = guild.get_member(x[0])
+            if member:
+                name = member.display_name
+            else:
+                name = f'``Member with ID {x[0]} not found``'
+            string += f'{k}: | {name} - ``{x[1]}``\n'
+        return string
 
     @commands.check(Checks.manager_check)
     @commands.command()
     async def add_image(self, ctx, name, url: typing.Optional[str]):
         if ctx.message.attachments:
             url = ctx.message.attachments[0].url
-        if url:
-            if self.url_check(url):
+        if not normalize(name):
+            await ctx.send(embed=discord.Embed(description="The name needs letters or numbers, it's used as the answer",
+                                               color=discord.Color.red()))
+        elif url:
+            result = await self.url_check(url)
+            if result:
                 # adding the image
+                state = await self.states.get(ctx.guild.id)
                 name = name.lower()
-                c = await self.connection.cursor()
-                await c.execute("INSERT INTO images (url, name) VALUES (?, ?)", (url, name))
-
-                img_id = c.get_cursor().lastrowid  # getting the id
+                sha256, image_hash = await self.prepare_image(url)
+                if image_hash is not None:
+                    duplicates = state.catalog.duplicates(image_hash)
+                    if duplicates:
+                        ids = ', '.join(str(x.img_id) for _, x in duplicates[:10])
+                        await ctx.send(embed=discord.Embed(description=f'This image was already added. ID: {ids}',
+                                                           color=discord.Color.red()))
+                        return
+                image = await state.catalog.add(self.pool, url, name, sha256, image_hash)
                 # sending the success message
                 embed = discord.Embed()
                 embed.description = 'Image added successfully'
                 embed.colour = discord.Color.green()
-                embed.set_footer(text=f'ID: {img_id}')
+                embed.set_footer(text=f'ID: {image.img_id}')
                 await ctx.send(embed=embed)
             else:
-                await ctx.send(embed=discord.Embed(description='Not supported URL or file type',
+                await ctx.send(embed=discord.Embed(description=f'Not supported URL or file type: {result.reason}',
                                                    color=discord.Color.red()))
         else:
             await ctx.send(embed=discord.Embed(description='URL or attachment is required',
                                                color=discord.Color.red()))
 
+    async def prepare_image(self, url):
+        """Downloads the image into the local store and makes its perceptual hash
+        Returns (sha256, phash), sha256 is None if it couldn't be stored (the url will be used instead)
+        and phash is None if it couldn't be made"""
+        sha256 = None
+        if self.store is not None:
+            try:
+                sha256 = await self.store.download(self.validator.session, url)
+            except TooBig:
+                if self.store.max_file_size >= max_download:
+                    # too big to hash as well, not downloading it again
+                    return None, None
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                print(f"Couldn't store {url}: {e}")
+        return sha256, await self.image_hash(url, sha256)
+
+    async def image_hash(self, url, sha256=None):
+        """Makes the perceptual hash of the image, using the local copy if there is one
+        Returns None if it couldn't be made"""
+        loop = self.bot.loop
+        try:
+            path = self.store.get(sha256) if self.store and sha256 else None
+            if path:
+                data = await loop.run_in_executor(None, path.read_bytes)
+            else:
+                async with self.validator.session.get(url) as resp:
+                    resp.raise_for_status()
+                    if (resp.content_length or 0) > max_download:
+                        return None
+                    # content_length can be missing, so counting while reading
+                    data = bytearray()
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        data += chunk
+                        if len(data) > max_download:
+                            return None
+                    data = bytes(data)
+            return await loop.run_in_executor(None, phash.dhash, data)
+        except Exception as e:
+            # bad download or PIL can't read it, not worth failing over
+            print(f"Couldn't hash {url}: {e}")
+            return None
+
+    @commands.check(Checks.manager_check)
+    @commands.command()
+    async def hash_images(self, ctx):
+        """Makes the perceptual hash of the images that were added without one"""
+        state = await self.states.get(ctx.guild.id)
+        missing = [x for x in state.catalog if x.phash is None]
+        semaphore = asyncio.Semaphore(4)
+
+        async def make(image):
+            async with semaphore:
+                return image.img_id, await self.image_hash(image.url, image.sha256)
+
+        results = await asyncio.gather(*(make(x) for x in missing))
+        hashes = {img_id: value for img_id, value in results if value is not None}
+        await state.catalog.set_hashes(self.pool, hashes)
+
+        await ctx.send(embed=discord.Embed(description=f'Hashed {len(hashes)} / {len(missing)} images',
+                                           color=discord.Color.green()))
+
+    @staticmethod
+    def read_manifest(filename, text):
+        """Reads a CSV (name,url header) or JSON ([{"name": ..., "url": ...}]) manifest
+        Returns a list of (name, url)"""
+        if filename.lower().endswith('.json'):
+            rows = json.loads(text)
+            if not isinstance(rows, list):
+                raise ValueError('JSON manifest has to be a list')
+            entries = []
+            for row in rows:
+                if not isinstance(row, dict):
+                    raise ValueError('JSON manifest rows have to be objects with a name and url')
+                entries.append((str(row.get('name') or ''), str(row.get('url') or '')))
+            return entries
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or 'name' not in reader.fieldnames or 'url' not in reader.fieldnames:
+            raise ValueError('CSV manifest needs a name,url header')
+        return [(row['name'] or '', row['url'] or '') for row in reader]
+
+    @commands.check(Checks.manager_check)
+    @commands.command()
+    async def import_images(self, ctx, manifest: typing.Optional[str]):
+        """Adds many images at once
+        Uses every image attached to the message (named after the file),
+        a attached .csv / .json manifest or a manifest in the data folder"""
+        entries = []  # (name, url)
+        try:
+            if manifest:
+                data_folder = Path(env_config.data_folder).resolve()
+                location = (data_folder / manifest).resolve()
+                if data_folder not in location.parents or not location.is_file():
+                    raise ValueError(f"Can't find {manifest} in the data folder")
+                read = functools.partial(location.read_text, encoding='utf-8-sig')
+                text = await self.bot.loop.run_in_executor(None, read)
+                entries += self.read_manifest(location.name, text)
+
+            for attachment in ctx.message.attachments:
+                if attachment.filename.lower().endswith(('.csv', '.json')):
+                    text = (await attachment.read()).decode('utf-8-sig')
+                    entries += self.read_manifest(attachment.filename, text)
+                else:
+                    entries.append((os.path.splitext(attachment.filename)[0], attachment.url))
+        except (ValueError, UnicodeDecodeError, discord.HTTPException) as e:
+            await ctx.send(embed=discord.Embed(description=f'Could not read the manifest: {e}',
+                                               color=discord.Color.red()))
+            return
+
+        if not entries:
+            await ctx.send(embed=discord.Embed(description='Attach images or a manifest',
+                                               color=discord.Color.red()))
+            return
+
+        # checking all the urls at once (the validator limits how many at a time)
+        checked = await self.validator.check_many([url for _, url in entries])
+
+        semaphore = asyncio.Semaphore(import_concurrency)
+
+        async def prepare(url):
+            async with semaphore:
+                return await self.prepare_image(url)
+
+        rows = [(k, name.strip().lower(), result)
+                for k, ((name, _), result) in enumerate(zip(entries, checked), start=1)]
+        valid = [(k, name, result) for k, name, result in rows if normalize(name) and result]
+        prepared = await asyncio.gather(*(prepare(result.url) for _, _, result in valid))
+
+        state = await self.states.get(ctx.guild.id)
+        lines = {}  # row number: result
+        for k, name, result in rows:
+            if not name:
+                lines[k] = 'missing a name'
+            elif not normalize(name):
+                lines[k] = f"{name} - the name needs letters or numbers, it's used as the answer"
+            elif not result:
+                lines[k] = f'{name} - {result.reason}'
+
+        to_add = []  # (row number, (url, name, sha256, phash))
+        new_hashes = phash.HashIndex()  # to also catch duplicates inside the import
+        for (k, name, result), (sha256, image_hash) in zip(valid, prepared):
+            if image_hash is not None:
+                duplicates = state.catalog.duplicates(image_hash)
+                if duplicates:
+                    lines[k] = f'{name} - already added as ID {duplicates[0][1].img_id}'
+                    continue
+                if new_hashes.search(image_hash):
+                    lines[k] = f'{name} - same image as a row above'
+                    continue
+                new_hashes.add(image_hash, k)
+            to_add.append((k, (result.url, name, sha256, image_hash)))
+
+        records = await state.catalog.add_many(self.pool, [x for _, x in to_add])
+        for (k, _), record in zip(to_add, records):
+            lines[k] = f'{record.name} - added, ID {record.img_id}'
+
+        report = page.Page()
+        for k in sorted(lines):
+            report.add_line(f'{k}: {lines[k]}')
+
+        paginator = page.Paginator(self.bot, ctx, report.pages(),
+                                   footer=f'Imported {len(records)} / {len(entries)}')
+        await paginator.start()
+
     @commands.check(Checks.manager_check)
     @commands.command()
     async def remove_image(self, ctx, img_id: int):
-        c = await self.connection.cursor()
-        await c.execute("SELECT * FROM images WHERE img_id=?", (img_id))
         # make sure it exists
-        if await c.fetchone():
-            await c.execute("DELETE FROM images WHERE img_id=?", (img_id))
+        state = await self.states.get(ctx.guild.id)
+        if await state.catalog.remove(self.pool, img_id):
             await ctx.send(embed=discord.Embed(description=f"Successfully removed the image",
                                                color=discord.Color.green()))
         else:
@@ -116,167 +501,320 @@ class Image(commands.Cog):
     @commands.check(Checks.manager_check)
     @commands.command()
     async def list_image(self, ctx):
-        c = await self.connection.cursor()
-        await c.execute("SELECT * FROM images")
-        images = await c.fetchall()
-        pages = []
-        for image in images:
-            embed = discord.Embed(description=f'ID - {image[0]}, Name - {image[2]}', color=discord.Color.blue())
+        state = await self.states.get(ctx.guild.id)
+
+        def render(images, index):
+            # one image per page
+            if not images:
+                return 'This image was removed'
+            image = images[0]
+            record = state.catalog.get(image[0])
+            answers = ', '.join(record.answers) if record else ''
+            embed = discord.Embed(description=f'ID - {image[0]}, Name - {image[2]}\nAnswers - {answers}',
+                                  color=discord.Color.blue())
             embed.set_image(url=image[1])
-            pages.append(embed)
-        paginator = page.Paginator(self.bot, ctx, pages)
+            return embed
+
+        provider = page.KeysetProvider(len(state.catalog), 1, functools.partial(self.image_page, ctx.guild.id),
+                                       key=lambda x: x[0], render=render)
+        paginator = page.Paginator(self.bot, ctx, provider)
         await paginator.start()
 
+    @commands.check(Checks.manager_check)
+    @commands.group()
+    async def answer(self, ctx):
+        if ctx.invoked_subcommand is None:
+            raise commands.CommandNotFound()
+
+    @answer.command(name='add')
+    @commands.check(Checks.manager_check)
+    async def answer_add(self, ctx, img_id: int, *, text):
+        """Adds another answer to a image"""
+        state = await self.states.get(ctx.guild.id)
+        text = await state.catalog.add_answer(self.pool, img_id, text)
+        if text is None:
+            await ctx.send(embed=discord.Embed(description="I can't find that image or the answer is empty",
+                                               color=discord.Color.red()))
+            return
+        embed = discord.Embed(description=f'Added ``{text}`` as a answer', color=discord.Color.green())
+        others = [x for x in await state.catalog.with_answer(self.pool, text) if x != img_id]
+        if others:
+            embed.set_footer(text=f'Also a answer for ID: {", ".join(str(x) for x in others[:10])}')
+        await ctx.send(embed=embed)
+
+    @answer.command(name='remove')
+    @commands.check(Checks.manager_check)
+    async def answer_remove(self, ctx, img_id: int, *, text):
+        state = await self.states.get(ctx.guild.id)
+        try:
+            removed = await state.catalog.remove_answer(self.pool, img_id, text)
+        except ValueError:
+            await ctx.send(embed=discord.Embed(description="Can't remove the last answer, "
+                                                           f'add another one first with {ctx.prefix}answer add',
+                                               color=discord.Color.red()))
+            return
+        if removed:
+            await ctx.send(embed=discord.Embed(description='Removed the answer successfully',
+                                               color=discord.Color.green()))
+        else:
+            await ctx.send(embed=discord.Embed(description="I can't find that answer",
+                                               color=discord.Color.red()))
+
+    @answer.command(name='list')
+    @commands.check(Checks.manager_check)
+    async def answer_list(self, ctx, img_id: int):
+        state = await self.states.get(ctx.guild.id)
+        image = state.catalog.get(img_id)
+        if image is None:
+            await ctx.send(embed=discord.Embed(description="I can't find that image", color=discord.Color.red()))
+        elif image.answers:
+            string = ''.join(f'- {x}\n' for x in image.answers)
+            await ctx.send(embed=discord.Embed(title=f'Answers for {img_id}', description=string,
+                                               color=discord.Color.blue()))
+        else:
+            await ctx.send(embed=discord.Embed(description='That image has no answers', color=discord.Color.blue()))
+
     @commands.check(Checks.manager_check)
     @commands.command()
     async def send_image(self, ctx):
-        self.image_before_loop.restart(forced=True)
-
-    # noinspection PyCallingNonCallable
-    @tasks.loop()
-    async def image_before_loop(self, forced=False):
-        time = [17, 30]  # hour, minute (24 hours)
-
-        def get_time(days):
-            # gives back timedelta depending on the time
-            now = datetime.now()
-            time_to = datetime(now.year, now.month, now.day, hour=time[0], minute=time[1])
-            time_to = time_to + timedelta(days=days)
-            time_to = time_to - now
-            return time_to
-
-        later = get_time(days=0)
-
-        if (self.loop_started and later.days < 0) or forced:
-            image = self.image
-            if self.image_sent:
-                self.image_loop.cancel()
-                channel = self.channel
-                await channel.send(embed=discord.Embed(title='Ran out of time!',
-                                                       description=f'The answer was ``{image[2]}``',
-                                                       color=discord.Color.red()))
-
-            # not going to change self.image_sent since its going to be started again
-            if env_config.debug:
-                print('Sending image')
-            self.image_loop.start()
-
-        elif self.loop_started is False:
-            self.loop_started = True
-            print('Starting image loop')
-
-        # setting it up to where its 24 hours repeating. Basically once per day at a certain time
-        later = get_time(days=0)
-        if later.days < 0 or forced:
-            # if the time passed or we forced an image to be sent
-            later = get_time(days=1)
+        """Starts a round now, doesn't change the schedule"""
+        await self.start_round(await self.states.get(ctx.guild.id))
 
+    async def scheduled_round(self, slot):
+        """Called by the scheduler whenever a slot is due"""
+        await self.pool.execute("UPDATE schedule SET last_run=? WHERE slot_id=?", (slot.last_run, slot.slot_id))
         if env_config.debug:
-            print(f'image_time - {later} - forced: {forced}')
-
-        # changing the time then loop it again
-        self.image_before_loop.change_interval(seconds=later.total_seconds())
+            print(f'Sending image - slot {slot.slot_id}')
+        if self.bot.get_guild(slot.guild_id) is None:
+            print(f"Can't send image, slot {slot.slot_id} is for guild {slot.guild_id} which I'm not in")
+            return
+        await self.start_round(await self.states.get(slot.guild_id))
+
+    async def add_slot(self, ctx, **kwargs):
+        """Saves the slot and adds it to the scheduler"""
+        try:
+            if kwargs.get('timezone') is not None:
+                ZoneInfo(kwargs['timezone'])  # making sure it exists
+            Slot(None, ctx.guild.id, **kwargs)
+        except (ValueError, ZoneInfoNotFoundError, OSError):
+            await ctx.send(embed=discord.Embed(description='Not a valid time, interval or timezone',
+                                               color=discord.Color.red()))
+            return
+
+        results = await self.pool.batch([(
+            "INSERT INTO schedule (guild_id, hour, minute, interval, timezone, catch_up) VALUES (?, ?, ?, ?, ?, ?)",
+            (ctx.guild.id, kwargs.get('hour'), kwargs.get('minute'), kwargs.get('interval'), kwargs.get('timezone'),
+             kwargs.get('catch_up', False)),
+            'lastrowid'
+        )])
+        slot = Slot(results[0], ctx.guild.id, **kwargs)
+        self.scheduler.add(slot)
+
+        embed = discord.Embed(description=f'Added slot {slot.slot_id}: {slot.describe()}',
+                              color=discord.Color.green())
+        embed.set_footer(text=f'Use {ctx.prefix}schedule list to see the schedule')
+        await ctx.send(embed=embed)
 
-    # noinspection PyCallingNonCallable
-    @tasks.loop(count=1)
-    async def image_loop(self):
-        self.image_sent = True  # start of the task
+    @commands.check(Checks.manager_check)
+    @commands.group()
+    async def schedule(self, ctx):
+        if ctx.invoked_subcommand is None:
+            raise commands.CommandNotFound()
 
-        guild = self.guild
-        prefix = self.bot.command_prefix
+    @schedule.command(name='daily')
+    @commands.check(Checks.manager_check)
+    async def schedule_daily(self, ctx, time, timezone: typing.Optional[TimeZone] = None, catch_up: bool = False):
+        """Adds a round every day at time (HH:MM, 24 hours)
+        timezone is a name like America/New_York, the bot's local time is used if left out"""
+        try:
+            hour, minute = (int(x) for x in time.split(':'))
+        except ValueError:
+            raise commands.BadArgument('time has to be HH:MM')
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise commands.BadArgument('time has to be HH:MM')
+        await self.add_slot(ctx, hour=hour, minute=minute, timezone=timezone, catch_up=catch_up)
+
+    @schedule.command(name='every')
+    @commands.check(Checks.manager_check)
+    async def schedule_every(self, ctx, minutes: int, catch_up: bool = False):
+        """Adds a round every X minutes"""
+        await self.add_slot(ctx, interval=minutes * 60, catch_up=catch_up)
 
-        c = await self.connection.cursor()
-        await c.execute("SELECT * FROM images")
-
-        # grabbing the list of Images
-        image_list = await c.fetchall()
-
-        # getting the ignored channels
-        ignore_list = []
-        await c.execute("SELECT * FROM ignore")
-        for row in await c.fetchall():
-            ignore_list.append(row[0])
-
-        # getting all the text channels without the ignored channels
-        channel_list = []
-        for x in guild.channels:
-            if isinstance(x, discord.TextChannel):
-                if x.id not in ignore_list:
-                    channel_list.append(x)
-
-        # sending the image and waiting for a response
-        if channel_list:  # making sure we got channels to send to
-            if image_list:  # making sure we got images
-                channel = channel_list[randint(0, len(channel_list) - 1)]  # grabbing a random text channel
-                image = image_list[randint(0, len(image_list) - 1)]  # grabbing a random image
-
-                self.channel = channel
-                self.image = image
-
-                # id, url, name - image[0], image[1], image[2]
-                async def send_image():
-                    embed = discord.Embed()
-                    embed.title = "Guess the name of the image"
-                    embed.set_footer(text=f'Image not showing? Do {prefix}refresh | ID - {image[0]}')
-                    embed.set_image(url=image[1])
-                    embed.colour = discord.Color.blue()
-                    await channel.send(embed=embed)
-                await send_image()
+    @schedule.command(name='remove')
+    @commands.check(Checks.manager_check)
+    async def schedule_remove(self, ctx, slot_id: int):
+        slot = self.scheduler.slots.get(slot_id)
+        if slot is not None and slot.guild_id == ctx.guild.id:
+            await self.pool.execute("DELETE FROM schedule WHERE slot_id=?", (slot_id))
+            self.scheduler.remove(slot_id)
+            await ctx.send(embed=discord.Embed(description='Removed the slot successfully',
+                                               color=discord.Color.green()))
+        else:
+            await ctx.send(embed=discord.Embed(description="I can't find that slot",
+                                               color=discord.Color.red()))
 
-                def check(m):
-                    return m.channel.id == channel.id and (m.content.lower() == image[2]
-                                                           or m.content.lower() == f'{prefix}refresh')
-                while True:
-                    msg = await self.bot.wait_for('message', check=check)
-
-                    if msg.content != f'{prefix}refresh':
-                        await c.execute("SELECT * FROM users WHERE user_id=?", (msg.author.id))
-                        user = await c.fetchone()
-                        # making sure the user is in the database
-                        if user:
-                            await c.execute("UPDATE users SET points=? WHERE user_id=?", (user[1] + 1, msg.author.id))
-                            points = user[1] + 1
-                        else:
-                            await c.execute("INSERT INTO users VALUES (?,?)", (msg.author.id, 1))
-                            points = 1
-                        embed = discord.Embed(title=f'{msg.author.display_name} got the answer',
-                                              description=f'You received a point, you now have ``{points}`` '
-                                                          f'points\n\n Answer was ``{image[2]}``',
-                                              color=discord.Color.green())
-                        await channel.send(embed=embed)
-                        await c.execute("DELETE FROM images WHERE img_id=?", (image[0]))
-                        print(f'deleting {image[0]}')
-                        break
-                    else:
-                        await send_image()
+    @schedule.command(name='list')
+    @commands.check(Checks.manager_check)
+    async def schedule_list(self, ctx):
+        string = ''
+        for slot in self.scheduler.slots.values():
+            if slot.guild_id != ctx.guild.id:
+                continue
+            when = self.scheduler.next_run(slot.slot_id)
+            if when is None:
+                next_run = 'running now'
             else:
-                print("Can't send image, no images to send!")
+                # in the slot's timezone, the bot's local time if it doesn't have one
+                next_run = datetime.fromtimestamp(when, tz=dt_timezone.utc).astimezone(slot.tzinfo())
+                next_run = f'{next_run:%Y-%m-%d %H:%M %Z}'
+                if self.scheduler.is_running(slot.slot_id):
+                    next_run += ' (running now)'
+            string += f'{slot.slot_id}: {slot.describe()} - next: {next_run}\n'
+
+        if string:
+            await ctx.send(embed=discord.Embed(title='Schedule', description=string, color=discord.Color.blue()))
         else:
-            print("All Text channels are ignored or there isn't any text channels to send to!")
+            await ctx.send(embed=discord.Embed(description='Schedule is empty', color=discord.Color.blue()))
+
+    def pick_channel(self, state):
+        """Returns a random eligible channel of the guild that doesn't have a round
+        None if there aren't any"""
+        guild = self.bot.get_guild(state.guild_id)
+        if guild is None:
+            return None
+        active = state.rounds.dispatcher
+        # a few random tries, there should be more channels than rounds
+        for _ in range(8):
+            if not state.eligible:
+                return None
+            channel_id = state.eligible.choice()
+            channel = guild.get_channel(channel_id)
+            if channel is None:
+                # missed the channel getting deleted
+                state.eligible.discard(channel_id)
+            elif channel_id not in active:
+                return channel
+
+        for channel_id in list(state.eligible):
+            if channel_id not in active:
+                channel = guild.get_channel(channel_id)
+                if channel:
+                    return channel
+        return None
+
+    async def start_round(self, state):
+        """Starts a round in a random channel of the guild
+        If there are too many rounds, the oldest one runs out of time"""
+        if state.rounds.full():
+            await self.end_round(state, state.rounds.oldest())
+
+        image = state.catalog.random(exclude=state.rounds.in_play)  # a random image that isn't in a round
+        channel = self.pick_channel(state)  # grabbing a random text channel that isn't ignored
+
+        if channel is None:  # making sure we got channels to send to
+            print(f"All Text channels in {state.guild_id} are ignored or there isn't any text channels to send to!")
+        elif image is None:  # making sure we got images
+            print(f"Can't send image in {state.guild_id}, no images to send that aren't already in a round!")
+        else:
+            game = Round(channel, image, refresh=f'{self.bot.command_prefix}refresh')
+            state.rounds.start(game, self.run_round(state, game))
+
+    async def end_round(self, state, game):
+        """Stops the round and sends the answer"""
+        if game is not None and state.rounds.stop(game):
+            await game.channel.send(embed=discord.Embed(title='Ran out of time!',
+                                                        description=f'The answer was ``{game.image.name}``',
+                                                        color=discord.Color.red()))
+
+    async def run_round(self, state, game):
+        """Sends the image and waits for a response"""
+        channel = game.channel
+        image = game.image
+        prefix = self.bot.command_prefix
 
-        self.image_sent = False
+        async def send_image():
+            embed = discord.Embed()
+            embed.title = "Guess the name of the image"
+            embed.set_footer(text=f'Image not showing? Do {prefix}refresh | ID - {image.img_id}')
+            embed.colour = discord.Color.blue()
+
+            # uploading the local copy if there is one, discord.File streams it from the disk
+            path = self.store.get(image.sha256) if self.store and image.sha256 else None
+            if path:
+                filename = f'image{path.suffix}'
+                embed.set_image(url=f'attachment://{filename}')
+                await channel.send(embed=embed, file=discord.File(str(path), filename=filename))
+            else:
+                embed.set_image(url=image.url)
+                await channel.send(embed=embed)
+        await send_image()
+
+        while True:
+            answered, msg = await game.wait()
+
+            if answered:
+                game.scoring = True  # can't be stopped from here on
+                # giving the point and removing the image in one go
+                results = await self.pool.batch([
+                    (add_point, (state.guild_id, msg.author.id), 'one'),
+                    ("DELETE FROM images WHERE img_id=?", (image.img_id)),
+                ], transaction=True)
+                points = results[0][0]
+                state.catalog.discard(image.img_id)
+                embed = discord.Embed(title=f'{msg.author.display_name} got the answer',
+                                      description=f'You received a point, you now have ``{points}`` '
+                                                  f'points\n\n Answer was ``{image.name}``',
+                                      color=discord.Color.green())
+                await channel.send(embed=embed)
+                print(f'deleting {image.img_id}')
+                break
+            else:
+                await send_image()
 
     @commands.command()
     async def refresh(self, ctx):
         """Refreshes the image"""
-        # this actually refresh in the image_loop.
+        # this actually refresh in the round (see rounds.Round).
         # Adding this here so it doesn't error when trying to find the command
         pass
 
-    async def ignore(self, channel, ignore):
-        c = await self.connection.cursor()
-        await c.execute("SELECT * FROM ignore WHERE channel_id=?", (channel.id))
-        channel_ignore = await c.fetchone()
-
-        if channel_ignore and not ignore:
-            await c.execute("DELETE FROM ignore WHERE channel_id=?", (channel.id))
-        elif not channel_ignore and ignore:
-            await c.execute("INSERT INTO ignore VALUES (?)", (channel.id))
+    async def set_ignored(self, state, add=(), remove=()):
+        """Adds / removes channel ids from the guild's ignore list
+        Everything is saved in one transaction, only the ids that changed are written"""
+        add = {x for x in add if x not in state.ignored}
+        remove = {x for x in remove if x in state.ignored} - add
+
+        guild_id = state.guild_id
+        statements = []
+        if add:
+            statements.append(("INSERT OR IGNORE INTO ignore VALUES (?, ?)", [(guild_id, x) for x in add],
+                               'executemany'))
+        if remove:
+            statements.append(("DELETE FROM ignore WHERE guild_id=? AND channel_id=?",
+                               [(guild_id, x) for x in remove], 'executemany'))
+        if statements:
+            await self.pool.batch(statements, transaction=True)
+
+        state.ignored.update(add)
+        state.ignored.difference_update(remove)
+        for channel_id in add:
+            state.eligible.discard(channel_id)
+        guild = self.bot.get_guild(guild_id)
+        for channel_id in remove:
+            channel = guild.get_channel(channel_id) if guild else None
+            if channel:
+                state.update_eligible(channel)
+
+    async def ignore(self, state, channel, ignore):
+        if ignore:
+            await self.set_ignored(state, add=[channel.id])
+        else:
+            await self.set_ignored(state, remove=[channel.id])
 
     @commands.check(Checks.manager_check)
     @commands.command(name='ignore')
     async def ignore_command(self, ctx, channel: discord.TextChannel, ignore=True):
-        await self.ignore(channel, ignore)
+        await self.ignore(await self.states.get(ctx.guild.id), channel, ignore)
 
         if ignore:
             embed = discord.Embed(description=f'Added {channel} to the ignore list')
@@ -290,10 +828,8 @@ class Image(commands.Cog):
     @commands.check(Checks.manager_check)
     @commands.command()
     async def ignore_all_but(self, ctx, channel: discord.TextChannel):
-        for c in ctx.guild.channels:
-            if isinstance(c, discord.TextChannel):
-                await self.ignore(c, True)
-        await self.ignore(channel, False)
+        others = [c.id for c in ctx.guild.text_channels if c.id != channel.id]
+        await self.set_ignored(await self.states.get(ctx.guild.id), add=others, remove=[channel.id])
 
         embed = discord.Embed(description=f'Ignoring everything but {channel}')
         embed.set_footer(text=f'Use {ctx.prefix}ignore_list to see the list')
@@ -304,9 +840,8 @@ class Image(commands.Cog):
     @commands.check(Checks.manager_check)
     @commands.command()
     async def ignore_clear(self, ctx):
-        for c in ctx.guild.channels:
-            if isinstance(c, discord.TextChannel):
-                await self.ignore(c, False)
+        state = await self.states.get(ctx.guild.id)
+        await self.set_ignored(state, remove=list(state.ignored))
 
         embed = discord.Embed(description=f'Cleared the ignore list')
         embed.set_footer(text=f'Use {ctx.prefix}ignore_list to see the list')
@@ -317,15 +852,17 @@ class Image(commands.Cog):
     @commands.check(Checks.manager_check)
     @commands.command()
     async def ignore_list(self, ctx):
-        c = await self.connection.cursor()
+        state = await self.states.get(ctx.guild.id)
         channels = ''
-        await c.execute("SELECT * FROM ignore")
-        for row in await c.fetchall():
-            soda_can = ctx.guild.get_channel(row[0])
+        missing = []  # channels that got deleted
+        for channel_id in state.ignored:
+            soda_can = ctx.guild.get_channel(channel_id)
             if soda_can:
                 channels += f'- {soda_can.name}\n'
             else:
-                await c.execute("DELETE FROM ignore WHERE channel_id=?", (row[0]))
+                missing.append(channel_id)
+        if missing:
+            await self.set_ignored(state, remove=missing)
 
         if channels:
             await ctx.send(embed=discord.Embed(description=f'Ignored channels:\n{channels}',
@@ -334,40 +871,69 @@ class Image(commands.Cog):
             await ctx.send(embed=discord.Embed(description=f'Ignore list is empty',
                                                color=discord.Color.blue()))
 
+    @commands.check(Checks.developer_check)
+    @commands.command()
+    async def sql_stats(self, ctx, dump: bool = False):
+        """Shows how long the SQL statements took
+        total includes fetching the rows, p50 / p99 are only the execute step
+        If dump is true, it will also be saved to the data folder"""
+        if self.stats is None:
+            await ctx.send(embed=discord.Embed(description='SQL_STATS is not enabled',
+                                               color=discord.Color.red()))
+            return
+
+        report = self.stats.report()
+        if dump:
+            location = f'{env_config.data_folder}/sql_stats.json'
+            self.stats.dump(location)
+            await ctx.send(embed=discord.Embed(description=f'Saved to {location}',
+                                               color=discord.Color.green()))
+
+        pages = page.Page()
+        for row in report:
+            pages.add_line(f"``{row['sql']}``\n"
+                           f"count: {row['count']} | total: {row['total_ms']:.2f}ms | "
+                           f"p50: {row['p50_ms']:.2f}ms | p99: {row['p99_ms']:.2f}ms | "
+                           f"queued: {row['queued_ms']:.2f}ms | fetching rows: {row['fetch_ms']:.2f}ms")
+        paginator = page.Paginator(self.bot, ctx, pages.pages(), footer='SQL stats')
+        await paginator.start()
+
     @commands.guild_only()
     @commands.command()
     async def top(self, ctx):
-        c = await self.connection.cursor()
-        await c.execute("SELECT * FROM users ORDER BY points")
-        users = await c.fetchmany(10)
-        users = users[::-1]  # reversing the list for the for loop
+        users = await self.leaderboard_page(ctx.guild.id)
 
         embed = discord.Embed(title="Top Users", color=discord.Color.blue())
-        string = ''
-        for k, x in enumerate(users):
-            # 1 - ID, 2 - Points
-            member = ctx.guild.get_member(x[0])
-            if member:
-                name = member.display_name
-            else:
-                name = f'``Member with ID {x[0]} not found``'
-            string += f'{k + 1}: | {name} - ``{x[1]}``\n'
-
-        embed.description = string
+        embed.description = self.leaderboard_lines(ctx.guild, users)
+        embed.set_footer(text=f'Use {ctx.prefix}leaderboard to see everyone')
 
         await ctx.send(embed=embed)
 
     @commands.guild_only()
     @commands.command()
-    async def me(self, ctx):
-        c = await self.connection.cursor()
-        await c.execute("SELECT * FROM users WHERE user_id=?", (ctx.author.id))
+    async def leaderboard(self, ctx):
+        """Every user, going from the most points to the least"""
+        total = (await self.pool.fetchone("SELECT count(*) FROM users WHERE guild_id=?", (ctx.guild.id)))[0]
 
-        member = await c.fetchone()
+        def render(users, index):
+            return self.leaderboard_lines(ctx.guild, users, start=index * leaderboard_size + 1)
+
+        fetch = functools.partial(self.leaderboard_page, ctx.guild.id)
+        provider = page.KeysetProvider(total, leaderboard_size, fetch, key=lambda x: (x[1], x[0]), render=render)
+        paginator = page.Paginator(self.bot, ctx, provider, footer='Leaderboard')
+        await paginator.start()
+
+    @commands.guild_only()
+    @commands.command()
+    async def me(self, ctx):
+        member = await self.pool.fetchone("SELECT points FROM users WHERE guild_id=? AND user_id=?",
+                                          (ctx.guild.id, ctx.author.id))
         if not member:
-            await c.execute("INSERT INTO users VALUES (?, ?)", (ctx.author.id, 0))
-            member = [None, 0]  # first one isn't used, but we get 2 in a list from the database
-        embed = discord.Embed(color=discord.Color.blue(), description=f'Current score: {member[1]}')
+            # adding them, unless a round gave them a point since we looked
+            member = await self.pool.fetchone("INSERT INTO users (guild_id, user_id, points) VALUES (?, ?, 0) "
+                                              "ON CONFLICT(guild_id, user_id) DO UPDATE SET points=points "
+                                              "RETURNING points", (ctx.guild.id, ctx.author.id))
+        embed = discord.Embed(color=discord.Color.blue(), description=f'Current score: {member[0]}')
         embed.set_author(name=ctx.author.display_name, icon_url=str(ctx.author.avatar_url))
         await ctx.send(embed=embed)
 
@@ -14,7 +14,7 @@ class Moderation(commands.Cog):
     @commands.Cog.listener()
     async def on_ready(self):
         if not self.ready:  # so on_ready only runs once
-            self.checks = await Checks.create()
+            self.checks = await Checks.get()
             self.ready = True
 
     @commands.group()
@@ -26,8 +26,8 @@ class Moderation(commands.Cog):
     @role.command(name='add')
     @commands.check(Checks.developer_check)
     async def role_add(self, ctx, level: int, *, role: discord.Role):
-        if not await self.checks.get_role(role.id):
-            await self.checks.add_role(role.id, level)
+        if not await self.checks.get_role(ctx.guild.id, role.id):
+            await self.checks.add_role(ctx.guild.id, role.id, level)
             await ctx.send(embed=discord.Embed(description=f'Role {role.name} added successfully'
                                                            f'\nLevel is set to {level}',
                                                color=discord.Color.blue()))
@@ -38,8 +38,8 @@ class Moderation(commands.Cog):
     @role.command(name='remove')
     @commands.check(Checks.developer_check)
     async def role_remove(self, ctx, *, role: discord.Role):
-        if await self.checks.get_role(role.id):
-            await self.checks.remove_role(role.id)
+        if await self.checks.get_role(ctx.guild.id, role.id):
+            await self.checks.remove_role(ctx.guild.id, role.id)
             await ctx.send(embed=discord.Embed(description=f'Removed the role successfully',
                                                color=discord.Color.blue()))
         else:
@@ -49,7 +49,7 @@ class Moderation(commands.Cog):
     @role.command(name='list')
     @commands.check(Checks.developer_check)
     async def role_list(self, ctx):
-        roles = await self.checks.get_all_roles()
+        roles = await self.checks.get_all_roles(ctx.guild.id)
         string = ''  # Error string, will get set to the description
         levels = {1: '', 2: '', 3: ''}  # going to get separated by fields later
 
@@ -60,7 +60,7 @@ class Moderation(commands.Cog):
                 if role:
                     levels[x[1]] += f'    - {role.name}\n'
                 else:
-                    await self.checks.remove_role(x[0])
+                    await self.checks.remove_role(ctx.guild.id, x[0])
         else:
             string = 'List is empty'
 
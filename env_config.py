@@ -23,7 +23,10 @@ token = os.getenv('TOKEN')
 debug = os.getenv('DEBUG')
 debug_id = os.getenv('DEBUG_ID')
 data_folder = os.getenv('DATA')
-main_guild = os.getenv('GUILD')
+main_guild = os.getenv('GUILD')  # optional, the guild data from before multi guild support belongs to
+sql_stats = os.getenv('SQL_STATS', 'false')  # optional, records how long the SQL statements take
+rounds = os.getenv('ROUNDS', '1')  # optional, how many image rounds can run at once in a guild
+image_store_size = os.getenv('IMAGE_STORE_SIZE', '512')  # optional, MB of images to keep locally. 0 to disable
 
 if token is None:
     raise EnvError('Missing TOKEN value!')
@@ -43,9 +46,7 @@ else:
     except ValueError:
         raise EnvError('DEBUG_ID has to be a number!')
 
-if main_guild is None:
-    raise EnvError('Missing GUILD value!')
-else:
+if main_guild is not None:
     try:
         main_guild = int(main_guild)
     except ValueError:
@@ -58,6 +59,25 @@ elif debug == 'True' or 'true':
 else:
     raise EnvError("DEBUG value has to be 'true' or 'false'")
 
+if sql_stats.lower() == 'true':
+    sql_stats = True
+elif sql_stats.lower() == 'false':
+    sql_stats = False
+else:
+    raise EnvError("SQL_STATS value has to be 'true' or 'false'")
+
+try:
+    rounds = int(rounds)
+except ValueError:
+    raise EnvError('ROUNDS has to be a number')
+if rounds < 1:
+    raise EnvError('ROUNDS has to be at least 1')
+
+try:
+    image_store_size = int(image_store_size)
+except ValueError:
+    raise EnvError('IMAGE_STORE_SIZE has to be a number')
+
 # make the directory if it doesn't exist
 if not Path(data_folder).is_dir():
     os.mkdir(data_folder)
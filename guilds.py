@@ -0,0 +1,148 @@
+"""
+Created by catzoo
+Description: Per guild state, loaded when a guild is used and dropped when it goes idle
+"""
+import time
+import asyncio
+
+import discord
+
+from catalog import ImageCatalog, RandomSet
+from rounds import RoundManager
+
+
+class GuildState:
+    """
+    Everything the image cog keeps in memory for one guild
+        - catalog - the guild's images (see catalog.ImageCatalog)
+        - ignored - ids of the ignored channels, same as the ignore table
+        - eligible - ids of the text channels that aren't ignored
+        - rounds - the rounds running in the guild
+
+    last_used is the time.monotonic() of the last time it was used
+    """
+    __slots__ = ('guild_id', 'catalog', 'ignored', 'eligible', 'rounds', 'last_used')
+
+    def __init__(self, guild_id, rounds=1):
+        self.guild_id = guild_id
+        self.catalog = ImageCatalog(guild_id)
+        self.ignored = set()
+        self.eligible = RandomSet()
+        self.rounds = RoundManager(limit=rounds)
+        self.last_used = time.monotonic()
+
+    async def load(self, pool, guild):
+        """Loads the guild's rows, guild is the discord.Guild (None if the bot can't see it)"""
+        await self.catalog.load(pool)
+        async for row in pool.iterate("SELECT channel_id FROM ignore WHERE guild_id=?", (self.guild_id)):
+            self.ignored.add(row[0])
+        if guild is not None:
+            for channel in guild.text_channels:
+                self.update_eligible(channel)
+
+    def update_eligible(self, channel, deleted=False):
+        """Adds / removes the channel from the eligible channels depending on
+        if its a text channel in the guild that isn't ignored"""
+        if (not deleted and isinstance(channel, discord.TextChannel) and channel.guild.id == self.guild_id
+                and channel.id not in self.ignored):
+            self.eligible.add(channel.id)
+        else:
+            self.eligible.discard(channel.id)
+
+    def idle(self, now, timeout):
+        """True if nothing is running and it hasn't been used for timeout seconds"""
+        return not self.rounds and now - self.last_used > timeout
+
+
+class GuildStates:
+    """
+    The loaded GuildStates, by guild id
+    Use:
+        - await get(guild_id)
+            - Returns the guild's state, loading it first if needed
+        - peek(guild_id)
+            - Returns the state only if its loaded, for things that don't
+              need to load it (example: messages when no round is running)
+        - discard(guild_id)
+            - Drops the state, stopping its rounds (example: the bot left the guild)
+        - evict_idle()
+            - Drops the states that are idle
+        - start() / stop()
+            - Runs evict_idle() every sweep seconds in the background
+
+    load is a coroutine function (guild_id) -> GuildState
+    Memory goes with the guilds that are being used instead of every guild the bot is in
+    """
+
+    def __init__(self, load, idle_timeout=30 * 60, sweep=60):
+        self._load = load
+        self.idle_timeout = idle_timeout
+        self.sweep = sweep
+        self._states = {}  # guild_id: GuildState
+        self._loading = {}  # guild_id: Future, so a guild is only loaded once at a time
+        self._task = None
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        return iter(list(self._states.values()))
+
+    def __contains__(self, guild_id):
+        return guild_id in self._states
+
+    def peek(self, guild_id):
+        # not counted as using it, chatting in a guild shouldn't keep its images loaded
+        return self._states.get(guild_id)
+
+    async def get(self, guild_id):
+        now = time.monotonic()
+        state = self._states.get(guild_id)
+        if state is not None:
+            state.last_used = now
+            return state
+
+        future = self._loading.get(guild_id)
+        if future is None:
+            # shared by everything that wants the guild while its loading
+            future = asyncio.ensure_future(self._create(guild_id))
+            self._loading[guild_id] = future
+        return await asyncio.shield(future)
+
+    async def _create(self, guild_id):
+        try:
+            state = await self._load(guild_id)
+            self._states[guild_id] = state
+            return state
+        finally:
+            del self._loading[guild_id]
+
+    def discard(self, guild_id):
+        state = self._states.pop(guild_id, None)
+        if state is not None:
+            for game in state.rounds:
+                state.rounds.stop(game)
+        return state
+
+    def evict_idle(self, now=None):
+        """Drops the idle states, returns how many were dropped"""
+        now = time.monotonic() if now is None else now
+        idle = [guild_id for guild_id, state in self._states.items() if state.idle(now, self.idle_timeout)]
+        for guild_id in idle:
+            del self._states[guild_id]
+        return len(idle)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep)
+            self.evict_idle()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
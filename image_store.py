@@ -0,0 +1,129 @@
+"""
+Created by catzoo
+Description: Local copies of the images, stored by their SHA-256
+    data_folder/images/<first 2 of the hash>/<hash>.<type>
+    The same image added twice is only stored once. When the store goes over
+    max_size the least recently used images get deleted, rounds then go back
+    to using the url.
+"""
+import os
+import hashlib
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from validator import sniff
+
+chunk_size = 64 * 1024
+
+
+class TooBig(Exception):
+    """Raised by ImageStore.download when the image is over max_file_size"""
+    pass
+
+
+class ImageStore:
+    """
+    Use:
+        - load()
+            - Scans the folder, blocking so run it in a executor
+        - download(session, url)
+            - Streams the url into the store, returns the sha256. Raises TooBig if it's too big
+        - get(sha256)
+            - Path of the image (marked as used), None if it's not stored
+    """
+
+    def __init__(self, folder, max_size, max_file_size=8 * 1024 * 1024):
+        self.folder = Path(folder)
+        self.max_size = max_size  # bytes for the whole store
+        self.max_file_size = min(max_file_size, max_size)  # Discord's upload limit by default
+        self.size = 0
+        self._files = OrderedDict()  # sha256: (path, size), least recently used first
+
+    def __contains__(self, sha256):
+        return sha256 in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def load(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        found = []
+        for sub in os.scandir(self.folder):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith('.'):
+                    continue
+                stat = entry.stat()
+                # mtime is updated whenever the image is used
+                found.append((stat.st_mtime, entry.name.split('.')[0], Path(entry.path), stat.st_size))
+
+        self._files.clear()
+        self.size = 0
+        for _, sha256, path, size in sorted(found):
+            self._files[sha256] = (path, size)
+            self.size += size
+        self._evict()
+
+    def get(self, sha256):
+        stored = self._files.get(sha256)
+        if stored is None:
+            return None
+        path = stored[0]
+        self._files.move_to_end(sha256)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # deleted outside of the bot
+            self._forget(sha256)
+            return None
+        return path
+
+    def _forget(self, sha256):
+        path, size = self._files.pop(sha256)
+        self.size -= size
+        return path
+
+    def _evict(self):
+        while self.size > self.max_size and self._files:
+            sha256 = next(iter(self._files))
+            path = self._forget(sha256)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    async def download(self, session, url):
+        temp = self.folder / f'.download-{uuid.uuid4().hex}'
+        digest = hashlib.sha256()
+        size = 0
+        head = b''  # start of the file, to get the type
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                with open(temp, 'wb') as f:
+                    async for chunk in resp.content.iter_chunked(chunk_size):
+                        size += len(chunk)
+                        if size > self.max_file_size:
+                            raise TooBig(f'{url} is over {self.max_file_size} bytes')
+                        if len(head) < 32:
+                            head += chunk[:32]
+                        digest.update(chunk)
+                        f.write(chunk)
+
+            sha256 = digest.hexdigest()
+            if sha256 in self._files and self.get(sha256):
+                # already stored
+                return sha256
+
+            path = self.folder / sha256[:2] / f'{sha256}.{sniff(head) or "bin"}'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(temp, path)
+            self._files[sha256] = (path, size)
+            self.size += size
+            self._evict()
+            return sha256
+        finally:
+            if temp.exists():
+                temp.unlink()
@@ -5,43 +5,58 @@ Description:
 """
 import discord
 import asyncio
+import heapq
+import time
+import traceback
+from collections import OrderedDict
+
+controls = ('⏪', '◀', '▶', '⏩', '☑')  # reactions used by Paginator
+timeout = 120.0  # seconds without a reaction before a Paginator stops
 
 
 class EmbedPage:
     """
     Similar to class Page, only more simpler and only helps with
     embed fields
+
+    Values that are too long get split into more fields (with the same title).
+    A new page is made when the embed hits max_fields or max_total characters
+    (Discord's limit is 6000 for the whole embed, the default leaves room for the footer)
     """
 
-    def __init__(self, max_fields=25, max_fields_title=256, max_fields_value=1024,
+    def __init__(self, max_fields=25, max_fields_title=256, max_fields_value=1024, max_total=5800,
                  color=discord.Colour.default()):
         self.max_fields = max_fields
         self.max_fields_title = max_fields_title
         self.max_fields_value = max_fields_value
-        self._pages = []
-        self.embed = discord.Embed()
+        self.max_total = max_total
         self.colour = color
+        self._pages = []
+        self.embed = discord.Embed(colour=self.colour)
+        self._total = 0  # characters in self.embed
 
-    def add_field(self, title, value, inline=False):
-        if len(title) > self.max_fields_title:
-            value = title[self.max_fields_title:]
-            title = title[:self.max_fields_title]
-
-        while len(value) > self.max_fields_value:
-            self.embed.add_field(name=title, value=value[:self.max_fields_value], inline=inline)
+    def _add(self, title, value, inline):
+        size = len(title) + len(value)
+        if self.embed.fields and (len(self.embed.fields) >= self.max_fields or self._total + size > self.max_total):
+            self._pages.append(self.embed)
+            self.embed = discord.Embed(colour=self.colour)
+            self._total = 0
+        self.embed.add_field(name=title, value=value, inline=inline)
+        self._total += size
 
-            if len(self.embed.fields) == self.max_fields:
-                self._pages.append(self.embed)
-                self.embed = discord.Embed()
+    def add_field(self, title, value, inline=False):
+        title = title[:self.max_fields_title]
+        value = value or '\u200b'  # discord doesn't allow empty values
 
-        self.embed.add_field(name=title, value=value[:self.max_fields_value], inline=inline)
-        if len(self.embed.fields) == self.max_fields:
-            self._pages.append(self.embed)
-            self.embed = discord.Embed()
+        step = self.max_fields_value
+        for start in range(0, len(value), step):
+            self._add(title, value[start:start + step], inline)
 
     def pages(self):
         if self.embed.fields:
             self._pages.append(self.embed)
+            self.embed = discord.Embed(colour=self.colour)
+            self._total = 0
         return self._pages
 
 
@@ -56,36 +71,49 @@ class Page:
     cut the string to where its below the maximum.
     But if the line is under the maximum, it will
     add the line to the next page
+
+    The lines of the current page are kept in a list and only joined
+    once the page is done, so adding lines stays linear
     """
 
     def __init__(self, maximum=2000):
         self.maximum = maximum
-        # temp_string, used to keep track of the next page
-        self.string = ''
+        self._lines = []  # lines of the next page
+        self._length = 0  # length of the lines in self._lines
         self._pages = []  # list of pages
 
+    @property
+    def string(self):
+        """The next page, so far"""
+        return ''.join(self._lines)
+
+    def _flush(self):
+        if self._lines:
+            self._pages.append(''.join(self._lines))
+            self._lines = []
+            self._length = 0
+
     def add_line(self, line):
         # checking if the line + string will be too big
         # string should already be below the maximum
         # so if string + line is too big, we'll just
         # add it to the pages
         line += '\n'
-        if len(self.string) + len(line) > self.maximum:
-            if self.string:
-                self._pages.append(self.string)
-                self.string = ''
-            while len(line) > self.maximum:
-                string = line[:self.maximum]
-                line = line[self.maximum:]
-                self._pages.append(string)
-            self.string = line
-        else:
-            self.string += line
+        if self._length + len(line) > self.maximum:
+            self._flush()
+            if len(line) > self.maximum:
+                # cutting the line into full pages, the rest goes on the next page
+                cut = len(line) - len(line) % self.maximum
+                if cut == len(line):
+                    cut -= self.maximum
+                for start in range(0, cut, self.maximum):
+                    self._pages.append(line[start:start + self.maximum])
+                line = line[cut:]
+        self._lines.append(line)
+        self._length += len(line)
 
     def add_page(self, string):
-        if self.string:
-            self._pages.append(self.string)
-            self.string = ''
+        self._flush()
 
         if len(string) > self.maximum:
             self.add_line(string)
@@ -93,39 +121,154 @@ class Page:
             self._pages.append(string)
 
     def pages(self):
-        if self.string:
-            self._pages.append(self.string)
-            self.string = ''
+        self._flush()
         return self._pages
 
 
+class PageProvider:
+    """
+    Gives the Paginator its pages only when they are needed
+    Override:
+        - count()
+            - How many pages there are (async)
+        - get(index)
+            - The page (str or discord.Embed) at index (async)
+    """
+
+    async def count(self):
+        raise NotImplementedError
+
+    async def get(self, index):
+        raise NotImplementedError
+
+
+class KeysetProvider(PageProvider):
+    """
+    PageProvider for database rows, using keyset pagination instead of OFFSET
+    Arguments:
+        - total: how many rows there are
+        - per_page: rows per page
+        - fetch(limit, after=None, before=None, last=False): async, returns rows in page order
+            - after: rows right after this key
+            - before: the rows right before this key
+            - last: the last rows
+            - nothing: the first rows
+        - key(row): the key of the row, used for after / before
+        - render(rows, index): makes the page
+
+    The first and last key of every page that was loaded is kept so
+    the next / previous page only needs the page next to it
+    """
+
+    def __init__(self, total, per_page, fetch, key, render):
+        self.total = total
+        self.per_page = per_page
+        self.fetch = fetch
+        self.key = key
+        self.render = render
+        self._bounds = {}  # index: (first key, last key)
+
+    async def count(self):
+        return -(-self.total // self.per_page)  # rounding up
+
+    async def get(self, index):
+        pages = await self.count()
+        if index == 0:
+            rows = await self.fetch(self.per_page)
+        elif index - 1 in self._bounds:
+            rows = await self.fetch(self.per_page, after=self._bounds[index - 1][1])
+        elif index + 1 in self._bounds:
+            rows = await self.fetch(self.per_page, before=self._bounds[index + 1][0])
+        elif index == pages - 1:
+            rows = await self.fetch(self.total - index * self.per_page, last=True)
+        else:
+            raise IndexError('page has to be next to a page that was already loaded')
+
+        if rows:
+            self._bounds[index] = (self.key(rows[0]), self.key(rows[-1]))
+        return self.render(rows, index)
+
+
+def _drop_result(future):
+    # a page that fell out of the cache, its error (if any) doesn't matter anymore
+    if not future.cancelled():
+        future.exception()
+
+
 class Paginator:
-    def __init__(self, bot, ctx, pages, footer=None, set_footer=True):
+    """
+    pages can be a list of pages (str or discord.Embed) or a PageProvider.
+    With a PageProvider only the page on screen is loaded, the pages next to it
+    are loaded in the background and the last few are kept (cache_size)
+    """
+
+    def __init__(self, bot, ctx, pages, footer=None, set_footer=True, cache_size=5):
         self.ctx = ctx
         self.pages = pages
         self.page_number = 0
+        self.page_count = 0 if isinstance(pages, PageProvider) else len(pages)
         self.bot = bot
         self.footer = footer
         self.set_footer = set_footer
-
-    def get_page(self):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # page number: future of the page, least recently used first
+        self.message = None  # the message showing the pages
+        self._done = None  # finished when the user closes it / it times out
+        # reactions are handled in their own tasks, this keeps them from changing the page at the same time
+        self._lock = asyncio.Lock()
+
+    def _load(self, number):
+        """Returns a future of the page, loading it if it isn't cached"""
+        future = self._cache.get(number)
+        if future is None:
+            future = asyncio.ensure_future(self.pages.get(number))
+            self._cache[number] = future
+        self._cache.move_to_end(number)
+        while len(self._cache) > self.cache_size:
+            _, old = self._cache.popitem(last=False)
+            if not old.done():
+                # left to finish, cancelling could stop the provider half way through its query
+                old.add_done_callback(_drop_result)
+        return future
+
+    def _prefetch(self):
+        for number in (self.page_number + 1, self.page_number - 1):
+            if 0 <= number < self.page_count:
+                self._load(number)
+        # the current page is the most recently used
+        self._cache.move_to_end(self.page_number)
+
+    async def _get_raw_page(self):
+        if not isinstance(self.pages, PageProvider):
+            return self.pages[self.page_number]
+        try:
+            page = await asyncio.shield(self._load(self.page_number))
+        except Exception:
+            # not keeping the failed page around
+            self._cache.pop(self.page_number, None)
+            raise
+        self._prefetch()
+        return page
+
+    async def get_page(self):
         """
         Gets the page depending on self.pages[self.page_number]
         
         returns: discord.Embed"""
         def add_footer(embed2):
             if self.footer is None and self.set_footer:
-                embed2.set_footer(text=f'Page: {self.page_number + 1} / {len(self.pages)}')
+                embed2.set_footer(text=f'Page: {self.page_number + 1} / {self.page_count}')
             elif self.set_footer:
-                embed2.set_footer(text=f'{self.footer} - Page: {self.page_number + 1} / {len(self.pages)}')
+                embed2.set_footer(text=f'{self.footer} - Page: {self.page_number + 1} / {self.page_count}')
             return embed2
 
-        if isinstance(self.pages[self.page_number], discord.Embed):
-            embed = self.pages[self.page_number]
+        page = await self._get_raw_page()
+        if isinstance(page, discord.Embed):
+            embed = page
             embed = add_footer(embed)
             return embed
 
-        embed = discord.Embed(description=self.pages[self.page_number])
+        embed = discord.Embed(description=page)
         embed.colour = discord.Colour.blue()
         embed = add_footer(embed)
 
@@ -136,7 +279,7 @@ class Paginator:
     """
 
     def next_page(self):
-        max_pages = len(self.pages) - 1
+        max_pages = self.page_count - 1
         if self.page_number < max_pages:
             self.page_number += 1
 
@@ -145,11 +288,49 @@ class Paginator:
             self.page_number -= 1
 
     def last_page(self):
-        self.page_number = len(self.pages) - 1
+        self.page_number = self.page_count - 1
 
     def first_page(self):
         self.page_number = 0
 
+    async def handle(self, emoji):
+        """Called by ReactionRouter when the author reacts"""
+        async with self._lock:
+            if self._done.done():
+                return  # closed / timed out while this was waiting
+            if emoji == '◀':
+                self.opposite_of_next_page()
+            elif emoji == '▶':
+                self.next_page()
+            elif emoji == '⏪':
+                self.first_page()
+            elif emoji == '⏩':
+                self.last_page()
+            elif emoji == '☑':
+                self._finish()
+                await self.message.delete()
+                return
+            else:
+                return
+            await self.message.edit(embed=await self.get_page())
+
+    async def expire(self):
+        """Called by ReactionRouter when nobody reacted in time"""
+        async with self._lock:
+            if self._done.done():
+                return
+            self._finish()
+            msg = self.message
+            embed = await self.get_page()
+            embed.description = f'{embed.description or ""}⚠ - Timeout Error'
+            await asyncio.gather(*(msg.remove_reaction(x, self.ctx.me) for x in controls), return_exceptions=True)
+            await msg.edit(embed=embed)
+
+    def _finish(self):
+        if not self._done.done():
+            self._done.set_result(None)
+        ReactionRouter.get(self.bot).remove(self.message.id)
+
     async def start(self):
         """
         Basically starts the loop
@@ -157,54 +338,104 @@ class Paginator:
         depending on the context. Then will wait for the user
         to react / respond and change the pages depending on the reaction
         """
+        if isinstance(self.pages, PageProvider):
+            self.page_count = await self.pages.count()
 
-        def check(reaction, user):
-            return user == self.ctx.author
-
-        if not self.pages:
+        if not self.page_count:
             await self.ctx.send('List is empty')
         else:
-            msg = await self.ctx.send(embed=self.get_page())
+            msg = await self.ctx.send(embed=await self.get_page())
+            self.message = msg
+            # can't really do much with one page
+            if self.page_count > 1:
+                self._done = asyncio.get_event_loop().create_future()
+                ReactionRouter.get(self.bot).add(self, timeout)
+                await asyncio.gather(*(msg.add_reaction(x) for x in controls))
+                await self._done
+
+
+class ReactionRouter:
+    """
+    One on_raw_reaction_add listener for all the paginators
+    Use:
+        - ReactionRouter.get(bot)
+            - The bot's router, made the first time
+        - add(paginator, timeout) / remove(message_id)
+
+    Reactions are sent to the paginator by message id (one dict lookup), so it
+    doesn't matter if the message is in the client's cache.
+    Timeouts are kept in one heap instead of a wait_for per paginator, a
+    reaction from the author pushes the timeout back.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._paginators = {}  # message id: [paginator, deadline]
+        self._heap = []  # (deadline, message id)
+        self._changed = asyncio.Event()
+        self._task = None
+
+    @classmethod
+    def get(cls, bot):
+        router = getattr(bot, '_reaction_router', None)
+        if router is None:
+            router = bot._reaction_router = cls(bot)
+            bot.add_listener(router.on_raw_reaction_add, 'on_raw_reaction_add')
+        return router
+
+    def __len__(self):
+        return len(self._paginators)
+
+    def _schedule(self, message_id, timeout):
+        deadline = time.monotonic() + timeout
+        self._paginators[message_id][1] = deadline
+        heapq.heappush(self._heap, (deadline, message_id))
+        self._changed.set()
+
+    def add(self, paginator, timeout):
+        self._paginators[paginator.message.id] = [paginator, None]
+        self._schedule(paginator.message.id, timeout)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._expire_loop())
+
+    def remove(self, message_id):
+        # the heap entry is skipped when it comes up
+        self._paginators.pop(message_id, None)
+
+    async def on_raw_reaction_add(self, payload):
+        entry = self._paginators.get(payload.message_id)
+        if entry is None:
+            return
+        paginator = entry[0]
+        if payload.user_id != paginator.ctx.author.id:
+            return
+        self._schedule(payload.message_id, timeout)
+        await paginator.handle(str(payload.emoji))
+
+    async def _expire_loop(self):
+        heap = self._heap
+        while self._paginators:
+            self._changed.clear()
+            # dropping entries of removed paginators / old deadlines
+            while heap and (heap[0][1] not in self._paginators or self._paginators[heap[0][1]][1] != heap[0][0]):
+                heapq.heappop(heap)
+            if not heap:
+                await self._changed.wait()
+                continue
+
+            deadline, message_id = heap[0]
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(heap)
+            paginator = self._paginators.pop(message_id)[0]
             try:
-                # if len(self.pages) == 1:
-                # can't really do much with one page
-                # await msg.add_reaction('☑')
-                # reaction, _ = await self.bot.wait_for('reaction_add', check=check, timeout=120.0)
-                # await msg.delete()
-                # else:
-                if len(self.pages) > 1:
-                    await msg.add_reaction('⏪')
-                    await msg.add_reaction('◀')
-                    await msg.add_reaction('▶')
-                    await msg.add_reaction('⏩')
-                    await msg.add_reaction('☑')
-                    while True:
-                        reaction, _ = await self.bot.wait_for('reaction_add', check=check, timeout=120.0)
-                        if str(reaction.emoji) == '◀':
-                            self.opposite_of_next_page()
-                            await msg.edit(embed=self.get_page())
-
-                        elif str(reaction.emoji) == '▶':
-                            self.next_page()
-                            await msg.edit(embed=self.get_page())
-
-                        elif str(reaction.emoji) == '⏪':
-                            self.first_page()
-                            await msg.edit(embed=self.get_page())
-
-                        elif str(reaction.emoji) == '⏩':
-                            self.last_page()
-                            await msg.edit(embed=self.get_page())
-
-                        elif str(reaction.emoji) == '☑':
-                            break
-                    await msg.delete()
-            except asyncio.TimeoutError:
-                embed = self.get_page()
-                embed.description += '⚠ - Timeout Error'
-                await msg.remove_reaction('◀', self.ctx.me)
-                await msg.remove_reaction('▶', self.ctx.me)
-                await msg.remove_reaction('☑', self.ctx.me)
-                await msg.remove_reaction('⏪', self.ctx.me)
-                await msg.remove_reaction('⏩', self.ctx.me)
-                await msg.edit(embed=embed)
+                await paginator.expire()
+            except Exception:
+                traceback.print_exc()
+        self._task = None
@@ -0,0 +1,111 @@
+"""
+Created by catzoo
+Description: Perceptual hashes of the images, used to find the same picture added twice
+    dhash - 64 bit difference hash, the same picture resized / recompressed gets
+            a hash that is only a few bits off
+    HashIndex - finds the hashes within a hamming distance without checking every hash
+"""
+import io
+
+from PIL import Image as PILImage
+
+hash_size = 8  # 8x8 = 64 bits
+
+
+def dhash(data):
+    """Returns the difference hash of the image (bytes) as a unsigned 64 bit int
+    Blocking, run it in a executor"""
+    with PILImage.open(io.BytesIO(data)) as image:
+        image.draft('L', (hash_size * 4, hash_size * 4))  # lets JPEG decode at a smaller size
+        small = image.convert('L').resize((hash_size + 1, hash_size), PILImage.LANCZOS)
+        pixels = list(small.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        start = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[start + col] > pixels[start + col + 1])
+    return value
+
+
+def to_signed(value):
+    """SQLite integers are signed 64 bit"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class HashIndex:
+    """
+    Multi-index hashing over hamming distance
+    Use:
+        - add(value, item) / remove(value, item)
+        - search(value)
+            - Returns [(distance, item)] within max_distance, closest first
+
+    The 64 bits are split into max_distance + 1 parts. Two hashes that are
+    max_distance or less apart have at least one part exactly the same, so only
+    the hashes sharing a part with value get compared instead of all of them
+    """
+    __slots__ = ('max_distance', '_parts', '_tables', '_size')
+
+    def __init__(self, max_distance=7):
+        self.max_distance = max_distance
+        parts = max_distance + 1
+        bits = hash_size * hash_size
+        # (shift, mask) of each part, spreading the leftover bits
+        self._parts = []
+        shift = 0
+        for k in range(parts):
+            width = bits // parts + (1 if k < bits % parts else 0)
+            self._parts.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [{} for _ in range(parts)]  # part value: {value: [items]}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value, item):
+        for (shift, mask), table in zip(self._parts, self._tables):
+            table.setdefault((value >> shift) & mask, {}).setdefault(value, []).append(item)
+        self._size += 1
+
+    def remove(self, value, item):
+        removed = False
+        for (shift, mask), table in zip(self._parts, self._tables):
+            key = (value >> shift) & mask
+            bucket = table.get(key)
+            items = bucket.get(value) if bucket else None
+            if items and item in items:
+                items.remove(item)
+                removed = True
+                if not items:
+                    del bucket[value]
+                    if not bucket:
+                        del table[key]
+        if removed:
+            self._size -= 1
+
+    def search(self, value):
+        found = {}
+        for (shift, mask), table in zip(self._parts, self._tables):
+            bucket = table.get((value >> shift) & mask)
+            if not bucket:
+                continue
+            for other, items in bucket.items():
+                if other not in found:
+                    found[other] = (distance(value, other), items)
+
+        results = []
+        for d, items in found.values():
+            if d <= self.max_distance:
+                results.extend((d, item) for item in items)
+        results.sort(key=lambda x: x[0])
+        return results
@@ -0,0 +1,145 @@
+"""
+Created by catzoo
+Description: Image rounds, routes messages to the round running in their channel
+"""
+import asyncio
+import traceback
+
+from catalog import normalize
+
+
+class Round:
+    """
+    A image round waiting for answers in one channel
+    Use:
+        - wait()
+            - Waits for the next message that answered or asked for a refresh
+              Returns (answered, message)
+
+    answers is a set of the image's normalized answers (see catalog.normalize)
+    so any of them can be matched with one lookup
+    scoring is set once someone answered and the point is being given
+    """
+    __slots__ = ('channel', 'image', 'answers', 'refresh', 'scoring', '_messages')
+
+    def __init__(self, channel, image, refresh):
+        self.channel = channel
+        self.image = image
+        self.answers = frozenset(image.answers)
+        self.refresh = normalize(refresh)  # the refresh command, example: pof?refresh
+        self.scoring = False
+        self._messages = asyncio.Queue()
+
+    def feed(self, message, content):
+        """Used by Dispatcher, content is the already normalized message"""
+        if content in self.answers:
+            self._messages.put_nowait((True, message))
+            return True
+        if content == self.refresh:
+            self._messages.put_nowait((False, message))
+            return True
+        return False
+
+    async def wait(self):
+        return await self._messages.get()
+
+
+class Dispatcher:
+    """
+    Holds the active rounds by channel id so on_message only has
+    to do one dict lookup to find out if the message is for a round
+    """
+    __slots__ = ('_rounds',)
+
+    def __init__(self):
+        self._rounds = {}  # channel_id: Round
+
+    def __len__(self):
+        return len(self._rounds)
+
+    def __contains__(self, channel_id):
+        return channel_id in self._rounds
+
+    def add(self, game):
+        self._rounds[game.channel.id] = game
+
+    def remove(self, game):
+        if self._rounds.get(game.channel.id) is game:
+            del self._rounds[game.channel.id]
+
+    def get(self, channel_id):
+        return self._rounds.get(channel_id)
+
+    def dispatch(self, message):
+        """Gives the message to the round in its channel
+        Returns True if the round used it"""
+        game = self._rounds.get(message.channel.id)
+        if game is None:
+            return False
+        return game.feed(message, normalize(message.content))
+
+
+class RoundManager:
+    """
+    Runs the rounds, each one in its own task
+    Use:
+        - start(game, coro)
+            - Runs coro as the round's task, the round gets messages until it finishes
+        - stop(game)
+            - Cancels the round. Returns False if it already finished or is
+              scoring (cancelling it then would leave the image half removed)
+        - oldest()
+            - The round that has been running the longest
+
+    in_play is the img_ids of the running rounds, so two rounds don't use the same image
+
+    limit is how many rounds can run at once, it's up to the caller to
+    stop a round before starting one past the limit
+    """
+    __slots__ = ('limit', 'dispatcher', 'in_play', '_tasks')
+
+    def __init__(self, limit=1):
+        self.limit = limit
+        self.dispatcher = Dispatcher()
+        self.in_play = set()  # img_id of every running round
+        self._tasks = {}  # Round: task, in the order they were started
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __iter__(self):
+        return iter(list(self._tasks))
+
+    def full(self):
+        return len(self._tasks) >= self.limit
+
+    def oldest(self):
+        return next(iter(self._tasks), None)
+
+    def start(self, game, coro):
+        self.dispatcher.add(game)
+        self.in_play.add(game.image.img_id)
+        task = asyncio.ensure_future(coro)
+        self._tasks[game] = task
+        task.add_done_callback(lambda t: self._finished(game, t))
+        return task
+
+    def _finished(self, game, task):
+        self.dispatcher.remove(game)
+        if self._tasks.pop(game, None) is not None:
+            self.in_play.discard(game.image.img_id)
+        if not task.cancelled() and task.exception() is not None:
+            exc = task.exception()
+            print(f'Round in {game.channel} errored:')
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    def stop(self, game):
+        task = self._tasks.get(game)
+        if task is None or task.done() or game.scoring:
+            return False
+        task.cancel()
+        # not waiting for the task, the callback cleans up
+        self.dispatcher.remove(game)
+        self._tasks.pop(game, None)
+        self.in_play.discard(game.image.img_id)
+        return True
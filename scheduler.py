@@ -0,0 +1,193 @@
+"""
+Created by catzoo
+Description: Schedules the image rounds
+    Slots are either daily (hour:minute in a timezone) or every X seconds.
+    The next time of every slot is kept in a min-heap, so the scheduler only
+    wakes up when the earliest slot is due.
+"""
+import asyncio
+import heapq
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+
+class Slot:
+    """
+    One row of the schedule table, guild_id is the guild the rounds are sent to
+        - daily: hour and minute are set, timezone is a IANA name (None for the bot's local time)
+        - interval: interval is set (seconds)
+
+    catch_up - if the slot was missed while the bot was off, run it once on start.
+        Otherwise missed runs are skipped
+    last_run - unix time of the last run, None if it never ran
+    """
+    __slots__ = ('slot_id', 'guild_id', 'hour', 'minute', 'interval', 'timezone', 'catch_up', 'last_run')
+
+    def __init__(self, slot_id, guild_id=None, hour=None, minute=None, interval=None, timezone=None,
+                 catch_up=False, last_run=None):
+        if interval is None and (hour is None or minute is None):
+            raise ValueError('slot needs a hour and minute or a interval')
+        if interval is not None and interval <= 0:
+            raise ValueError('interval has to be above 0')
+        self.slot_id = slot_id
+        self.guild_id = guild_id
+        self.hour = hour
+        self.minute = minute
+        self.interval = interval
+        self.timezone = timezone
+        self.catch_up = bool(catch_up)
+        self.last_run = last_run
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['slot_id'], guild_id=row['guild_id'], hour=row['hour'], minute=row['minute'],
+                   interval=row['interval'], timezone=row['timezone'], catch_up=row['catch_up'],
+                   last_run=row['last_run'])
+
+    def tzinfo(self):
+        if self.timezone is None:
+            return None  # the bot's local time
+        return ZoneInfo(self.timezone)
+
+    def describe(self):
+        if self.interval is not None:
+            return f'every {timedelta(seconds=self.interval)}'
+        return f'daily at {self.hour:02}:{self.minute:02} ({self.timezone or "local time"})'
+
+    def next_after(self, when):
+        """Returns the first unix time this slot runs at after when (unix time)"""
+        if self.interval is not None:
+            if self.last_run is None:
+                return when + self.interval
+            # staying lined up with the last run
+            missed = max(0, int((when - self.last_run) // self.interval))
+            return self.last_run + (missed + 1) * self.interval
+
+        tz = self.tzinfo()
+        now = datetime.fromtimestamp(when, tz=timezone.utc).astimezone(tz)
+        day = now.date()
+        while True:
+            # going by the wall clock so DST changes don't move the time
+            fire = datetime(day.year, day.month, day.day, self.hour, self.minute, tzinfo=tz)
+            if tz is None:
+                fire = fire.astimezone()
+            if fire.timestamp() > when:
+                return fire.timestamp()
+            day += timedelta(days=1)
+
+    def first_run(self, now):
+        """When the slot should first run after the bot starts"""
+        if self.last_run is None:
+            return self.next_after(now)
+        due = self.next_after(self.last_run)
+        if due <= now:
+            # it was missed while the bot was off
+            return now if self.catch_up else self.next_after(now)
+        return due
+
+
+class Scheduler:
+    """
+    Calls callback(slot) whenever a slot is due
+    Use:
+        - add(slot) / remove(slot_id)
+            - Can be used while running
+        - next_run(slot_id) / is_running(slot_id)
+            - When the slot runs next (None if it isn't scheduled) / if its callback is running
+        - start() / stop()
+
+    The callback runs in its own task and the slot is scheduled again
+    right away, so a slow round doesn't hold back the other slots.
+    slot.last_run is already updated when it's called
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.slots = {}  # slot_id: Slot
+        self._heap = []  # (unix time, slot_id)
+        self._due = {}  # slot_id: unix time in the heap, to skip removed / moved slots
+        self._changed = asyncio.Event()
+        self._task = None
+        self._running = set()  # callback tasks, kept here so they aren't garbage collected
+        self._active = set()  # ids of the slots with a callback running
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _push(self, slot_id, when):
+        self._due[slot_id] = when
+        heapq.heappush(self._heap, (when, slot_id))
+        self._changed.set()
+
+    def add(self, slot, now=None):
+        now = time.time() if now is None else now
+        self.slots[slot.slot_id] = slot
+        self._push(slot.slot_id, slot.first_run(now))
+
+    def remove(self, slot_id):
+        """The heap entry is left there and skipped when it comes up"""
+        self.slots.pop(slot_id, None)
+        self._due.pop(slot_id, None)
+        self._changed.set()
+
+    def next_run(self, slot_id):
+        return self._due.get(slot_id)
+
+    def is_running(self, slot_id):
+        return slot_id in self._active
+
+    def _peek(self):
+        # dropping entries of removed or moved slots
+        heap = self._heap
+        while heap and self._due.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    async def _run(self):
+        while True:
+            self._changed.clear()
+            top = self._peek()
+            if top is None:
+                await self._changed.wait()
+                continue
+
+            when, slot_id = top
+            delay = when - time.time()
+            if delay > 0:
+                try:
+                    # woken up early if a slot gets added / removed
+                    await asyncio.wait_for(self._changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            del self._due[slot_id]
+            slot = self.slots[slot_id]
+            slot.last_run = time.time()
+            task = asyncio.ensure_future(self._call(slot))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            self._push(slot_id, slot.next_after(slot.last_run))
+
+    async def _call(self, slot):
+        self._active.add(slot.slot_id)
+        try:
+            await self.callback(slot)
+        except Exception:
+            print(f'Schedule slot {slot.slot_id} errored:')
+            traceback.print_exc()
+        finally:
+            self._active.discard(slot.slot_id)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,143 @@
+"""
+Created by catzoo
+Description: Checks if image urls are actually images
+    Only the first bytes of the image are downloaded (ranged GET),
+    the image type is found by its magic bytes instead of the url.
+"""
+import asyncio
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import aiohttp
+
+# (offset, magic bytes, image type)
+signatures = [
+    (0, b'\xff\xd8\xff', 'jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'GIF87a', 'gif'),
+    (0, b'GIF89a', 'gif'),
+    (0, b'BM', 'bmp'),
+    (0, b'II*\x00', 'tiff'),
+    (0, b'MM\x00*', 'tiff'),
+    (0, b'BPG\xfb', 'bpg'),
+    (4, b'ftypheic', 'heif'),
+    (4, b'ftypheix', 'heif'),
+    (4, b'ftypmif1', 'heif'),
+    (4, b'ftypavif', 'avif'),
+]
+sniff_size = 32  # how many bytes are downloaded to find the type
+retry_statuses = (408, 429)  # 4xx statuses that might work later, these and 5xx aren't cached
+
+
+def sniff(data):
+    """Returns the image type from the first bytes of the file, None if its not a image"""
+    for offset, magic, image_type in signatures:
+        if data[offset:offset + len(magic)] == magic:
+            return image_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if len(data) > 2 and data[:1] == b'P' and data[1:2] in b'123456' and data[2:3].isspace():
+        return 'pnm'
+    return None
+
+
+class Result:
+    """What ImageValidator gives back for a url"""
+    __slots__ = ('url', 'ok', 'image_type', 'reason')
+
+    def __init__(self, url, ok, image_type=None, reason=None):
+        self.url = url
+        self.ok = ok
+        self.image_type = image_type
+        self.reason = reason  # why it failed
+
+    def __bool__(self):
+        return self.ok
+
+
+class ImageValidator:
+    """
+    Use:
+        - check(url)
+            - Returns a Result
+        - check_many(urls)
+            - Checks all of them at once (up to concurrency at a time),
+              returns the Results in the same order
+        - close()
+            - Closes the session if the validator made it
+
+    All requests go through one aiohttp session so connections get reused.
+    Results are cached (LRU) by url, except failures that might work later
+    (timeouts, connection errors, 408 / 429 / 5xx)
+    """
+
+    def __init__(self, session=None, concurrency=8, cache_size=1024, timeout=10):
+        self._session = session
+        self._own_session = session is None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self._cache = OrderedDict()  # url: Result
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._own_session = True
+        return self._session
+
+    async def close(self):
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _remember(self, result):
+        self._cache[result.url] = result
+        self._cache.move_to_end(result.url)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    async def _fetch(self, url):
+        """Returns (Result, if it can be cached)"""
+        headers = {'Range': f'bytes=0-{sniff_size - 1}'}
+        async with self.session.get(url, headers=headers, allow_redirects=True) as resp:
+            if resp.status not in (200, 206):
+                transient = resp.status >= 500 or resp.status in retry_statuses
+                return Result(url, False, reason=f'returned HTTP {resp.status}'), not transient
+            # servers that ignore Range send the whole file, only reading the start of it
+            data = b''
+            while len(data) < sniff_size:
+                chunk = await resp.content.read(sniff_size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+
+        image_type = sniff(data)
+        if image_type is None:
+            return Result(url, False, reason='not a supported image'), True
+        return Result(url, True, image_type=image_type), True
+
+    async def check(self, url):
+        cached = self._cache.get(url)
+        if cached is not None:
+            self._cache.move_to_end(url)
+            return cached
+
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+            return self._remember(Result(url, False, reason='not a http(s) url'))
+
+        async with self._semaphore:
+            try:
+                result, cache = await self._fetch(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # not caching these, it might work next time
+                return Result(url, False, reason=f'could not download ({type(e).__name__})')
+        return self._remember(result) if cache else result
+
+    async def check_many(self, urls):
+        return await asyncio.gather(*(self.check(url) for url in urls))